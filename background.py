@@ -0,0 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QObject, pyqtSignal, QCoreApplication
+
+# shared by everything that needs to get slow work (mostly network calls) off the GUI thread
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='background')
+
+
+# runs a function on the background executor and hands the result back on the GUI thread. starting the task
+# while it's already running doesn't start a second copy, instead it's run once more after the current run
+# finishes, with the most recent arguments, so any number of overlapping requests coalesce into one extra run
+class BackgroundTask(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(object)
+    # emitted from the worker thread, queued over to the GUI thread because this object lives there
+    _done = pyqtSignal(object, object)
+
+    def __init__(self, fn, parent=None):
+        super().__init__(parent)
+        self.fn = fn
+        self.running = False
+        self.pending_args = None
+        self._done.connect(self._on_done)
+
+    def start(self, *args):
+        if self.running:
+            self.pending_args = args
+            return False
+
+        self.running = True
+        executor.submit(self._run, args)
+        return True
+
+    def _run(self, args):
+        try:
+            self._done.emit(self.fn(*args), None)
+        except BaseException as err:
+            self._done.emit(None, err)
+
+    def _on_done(self, result, err):
+        self.running = False
+
+        if isinstance(err, SystemExit):
+            # sys.exit() on a worker thread would only end that thread, end the app like it would have before
+            QCoreApplication.exit(err.code if isinstance(err.code, int) else -1)
+            return
+        elif err is not None:
+            self.failed.emit(err)
+        else:
+            self.finished.emit(result)
+
+        if self.pending_args is not None:
+            args, self.pending_args = self.pending_args, None
+            self.start(*args)
+
+
+# lets plain threads hand values over to the GUI thread, emit() can be called from anywhere
+class ThreadSignal(QObject):
+    emitted = pyqtSignal(object)
+
+    def emit(self, value):
+        self.emitted.emit(value)
@@ -1,17 +1,44 @@
 import json
 import sys
 
+# lets get() tell the difference between no default and a default of None
+missing = object()
+
 
 class ConfigReader:
-    def __init__(self):
+    def __init__(self, path='config.json'):
+        self.path = path
         try:
-            with open('config.json') as file:
+            with open(path) as file:
                 self.config = json.load(file)
         except FileNotFoundError:
-            print('missing config.json file!')
+            print(f'missing {path} file!')
             sys.exit(-1)
 
-    def get(self, name):
-        if name not in self.config:
+    def get(self, name, default=missing):
+        # read once, a reload on another thread swaps in a whole new dict
+        config = self.config
+        if name not in config:
+            if default is not missing:
+                return default
             print(f'config error - tried to access "{name}" but it couldn\'t be found')
-        return self.config[name]
+        return config[name]
+
+    def reload(self):
+        # reads the file again, returns the names of the settings that were added, removed or changed. a file
+        # that's missing or half written (like while it's being saved) leaves the old settings in place
+        try:
+            with open(self.path) as file:
+                config = json.load(file)
+        except (OSError, ValueError) as err:
+            print(f'[config] couldn\'t reload {self.path}, keeping the old settings: {err}')
+            return set()
+
+        changed = {name for name in set(self.config) | set(config)
+                   if self.config.get(name, missing) != config.get(name, missing)}
+        self.config = config
+        return changed
+
+
+# shared by everything, so a reload is seen everywhere at once
+cfg = ConfigReader()
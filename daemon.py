@@ -0,0 +1,430 @@
+# fetches the weather and lights once for any number of dashboards, so a building full of them doesn't multiply
+# the API calls by the number of screens. run it with
+#   python daemon.py [--listen 127.0.0.1:8790 | --listen unix:/run/overseer-dashboard.sock]
+# and point dashboards at it with "daemon": "<the same address>" in their config.json.
+# every message is a line of JSON. a dashboard that connects is sent the whole state, {"seq": 1, "state": {...}},
+# then only what changes, {"seq": 2, "changes": [[path, value], [path], ...]}, where a change without a value is
+# something that was removed. the state is the same weather and lights the startup snapshot keeps
+import argparse
+import copy
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import easy_requests
+import metrics
+from config_reader import cfg
+from lights import Lights, LightStream, PollSchedule
+from weather import Weather, retry_interval
+
+default_address = '127.0.0.1:8790'
+# sent when nothing else has been for a while, so dashboards can tell a daemon that's gone from a quiet one
+keepalive_interval = 30
+# a dashboard that can't take an update in this long is dropped, rather than holding up every other one
+send_timeout = 5
+
+updates_total = metrics.Counter('dashboard_daemon_updates_total', 'State changes sent to dashboards', ['section'])
+sent_bytes_total = metrics.Counter('dashboard_daemon_sent_bytes_total', 'Bytes sent to dashboards', ['kind'])
+connections_total = metrics.Counter('dashboard_daemon_connections_total', 'Dashboards that connected')
+
+
+def parse_address(address):
+    # 'host:port' for TCP, 'unix:/path' or just '/path' for a Unix socket
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+    if address.startswith('/'):
+        return socket.AF_UNIX, address
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def encode(message):
+    return json.dumps(message, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+def diff(old, new, path=()):
+    # the changes that turn old into new. dicts, and lists that are the same length, only have the parts that
+    # changed sent, unless most of it changed, in which case the whole thing is smaller than the pieces
+    if type(old) is not type(new) or not isinstance(new, (dict, list)) or \
+            (isinstance(new, list) and len(old) != len(new)):
+        return [[list(path), new]]
+
+    if isinstance(new, dict):
+        removed = [key for key in old if key not in new]
+        changed = [key for key in new if key not in old or old[key] != new[key]]
+    else:
+        removed = []
+        changed = [i for i in range(len(new)) if old[i] != new[i]]
+
+    if len(changed) + len(removed) > max(1, len(new) // 2):
+        return [[list(path), new]]
+
+    changes = [[list(path) + [key]] for key in removed]
+    for key in changed:
+        if isinstance(new, dict) and key not in old:
+            changes.append([list(path) + [key], new[key]])
+        else:
+            changes += diff(old[key], new[key], path + (key,))
+    return changes
+
+
+def patch(state, changes):
+    # applies diff()'s changes, returning the new state since the whole of it can be replaced
+    for change in changes:
+        path = change[0]
+        if not path:
+            state = change[1]
+            continue
+
+        target = state
+        for key in path[:-1]:
+            target = target[key]
+        if len(change) == 1:
+            del target[path[-1]]
+        else:
+            target[path[-1]] = change[1]
+    return state
+
+
+# the current state, and every dashboard that's following it
+class StateHub:
+    def __init__(self):
+        self.state = {}
+        self.seq = 0
+        self.clients = set()
+        # held while anything's sent, so a dashboard that's joining can't miss an update or get one twice
+        self.lock = threading.Lock()
+
+    def log(self, msg):
+        print(f'[daemon] {msg}')
+
+    def publish(self, section, value):
+        # returns how many bytes each dashboard was sent, or 0 if nothing changed
+        value = copy.deepcopy(value)
+        with self.lock:
+            old = self.state.get(section)
+            if old == value:
+                return 0
+
+            self.seq += 1
+            self.state[section] = value
+            message = encode({'seq': self.seq, 'changes': diff(old, value, (section,))})
+            updates_total.inc(section=section)
+            self.broadcast(message, 'changes')
+            return len(message)
+
+    def keepalive(self):
+        with self.lock:
+            self.broadcast(b'\n', 'keepalive')
+
+    def broadcast(self, message, kind):
+        for client in list(self.clients):
+            try:
+                client.sendall(message)
+                sent_bytes_total.inc(len(message), kind=kind)
+            except OSError as err:
+                self.log(f'dropping a dashboard that isn\'t keeping up: {err}')
+                self.clients.discard(client)
+                client.close()
+
+    def join(self, client):
+        with self.lock:
+            message = encode({'seq': self.seq, 'state': self.state})
+            client.sendall(message)
+            sent_bytes_total.inc(len(message), kind='state')
+            self.clients.add(client)
+        connections_total.inc()
+
+    def leave(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+
+# socketserver only queues up 5 connections by default, a building's worth of dashboards reconnecting after the
+# daemon restarts would have most of them time out
+class TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(address, hub, on_command):
+    # a server for a daemon address, each dashboard gets a thread that listens for the commands it sends
+    family, bind_address = parse_address(address)
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            client = self.request
+            client.settimeout(send_timeout)
+            if family != socket.AF_UNIX:
+                # updates are small and should go out right away
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            hub.join(client)
+            try:
+                for command in read_lines(client):
+                    on_command(command)
+            except (OSError, ValueError):
+                pass
+            finally:
+                hub.leave(client)
+
+    if family == socket.AF_UNIX:
+        # a socket file left over from before a crash would stop us from binding
+        if os.path.exists(bind_address):
+            os.unlink(bind_address)
+        return UnixServer(bind_address, Handler)
+    return TCPServer(bind_address, Handler)
+
+
+def read_lines(sock):
+    # each line of JSON the other end sends. blank lines are keep-alives. a timeout only means nothing was sent
+    buffer = b''
+    while True:
+        try:
+            chunk = sock.recv(65536)
+        except socket.timeout:
+            continue
+        if not chunk:
+            return
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+# fetches everything and keeps the hub up to date. weather is refreshed on the main thread, lights are polled on
+# their own thread and followed on overseer's light stream when it has one
+class Daemon:
+    def __init__(self, address):
+        self.address = address
+        self.hub = StateHub()
+        self.weather = Weather()
+        self.lights = Lights()
+        # the stream and the poller can both change the lights
+        self.lights_lock = threading.Lock()
+        self.light_poll_schedule = PollSchedule(slowest=cfg.get('light-poll-max', 120))
+        self.poll_now = threading.Event()
+        self.light_stream = None
+        if cfg.get('light-stream', True):
+            self.light_stream = LightStream(f'{self.lights.overseer_url}lights/events', self.on_light_event,
+                                            self.on_light_stream_status)
+
+    def log(self, msg):
+        print(f'[daemon] {msg}')
+
+    def run(self):
+        server = make_server(self.address, self.hub, self.on_command)
+        threading.Thread(target=server.serve_forever, name='daemon-server', daemon=True).start()
+        threading.Thread(target=self.send_keepalives, name='daemon-keepalive', daemon=True).start()
+        threading.Thread(target=self.poll_lights, name='daemon-lights', daemon=True).start()
+        if self.light_stream is not None:
+            self.light_stream.start()
+        metrics.add_status('weather', self.weather.status)
+        self.log(f'serving dashboards on {self.address}')
+        self.refresh_weather()
+
+    def refresh_weather(self):
+        while True:
+            try:
+                state = self.weather.fetch()
+                if state is not None:
+                    self.weather.apply(state)
+                    if state.changed:
+                        self.hub.publish('weather', self.weather.dump())
+                delay = self.weather.next_fetch_in()
+            except Exception as err:
+                self.log(f'error refreshing weather: {err}')
+                delay = retry_interval
+            # each part of the weather is fetched on its own schedule, this wakes up for whichever is due next
+            time.sleep(max(1, delay))
+
+    def publish_lights(self):
+        with self.lights_lock:
+            self.hub.publish('lights', self.lights.get_lights())
+
+    def poll_lights(self):
+        while True:
+            changed = False
+            try:
+                polled = self.lights.fetch()
+                if polled is not None:
+                    with self.lights_lock:
+                        changed = self.lights.refresh(*polled)
+            except Exception as err:
+                self.lights.log(f'error reaching overseer: {err}')
+            except SystemExit:
+                # overseer doesn't trust us, there's nothing to serve
+                os._exit(-1)
+            if changed:
+                self.publish_lights()
+            self.light_poll_schedule.polled(changed)
+
+            # while the stream is up it has everything, only poll when a dashboard asks
+            while not self.poll_now.wait(self.light_poll_schedule.next_delay()):
+                if self.light_stream is None or not self.light_stream.connected:
+                    break
+            self.poll_now.clear()
+
+    def on_light_event(self, data):
+        with self.lights_lock:
+            changed = self.lights.apply_event(data)
+        if changed or isinstance(data, list):
+            self.publish_lights()
+
+    def on_light_stream_status(self, connected):
+        if connected:
+            # anything could have changed while the stream was down
+            self.poll_now.set()
+
+    def on_command(self, command):
+        # dashboards change lights on overseer themselves, then ask for the lights to be checked so every other
+        # dashboard hears about it too
+        if command.get('refresh') == 'lights':
+            self.light_poll_schedule.interacted()
+            self.poll_now.set()
+
+    def send_keepalives(self):
+        while True:
+            time.sleep(keepalive_interval)
+            self.hub.keepalive()
+
+
+# follows a daemon on its own thread, like LightStream does for overseer. on_update is called with
+# (section, value) for each part of the state that changed, and on_status with whether it's connected
+class DaemonClient:
+    def __init__(self, address, on_update, on_status, read_timeout=keepalive_interval * 3, max_backoff=30):
+        self.address = address
+        self.on_update = on_update
+        self.on_status = on_status
+        self.read_timeout = read_timeout
+        self.max_backoff = max_backoff
+        self.connected = False
+        self.stopped = False
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='daemon-client', daemon=True)
+
+    def log(self, msg):
+        print(f'[daemon] {msg}')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def send(self, command):
+        # safe to call from any thread, commands sent while disconnected are dropped
+        sock = self.sock
+        if sock is None:
+            return False
+        try:
+            with self.send_lock:
+                sock.sendall(encode(command))
+            return True
+        except OSError:
+            return False
+
+    def set_connected(self, connected):
+        if connected != self.connected:
+            self.connected = connected
+            self.on_status(connected)
+
+    def run(self):
+        backoff = 1
+        while not self.stopped:
+            try:
+                self.listen()
+                backoff = 1
+            except (OSError, ValueError) as err:
+                if self.connected:
+                    self.log(f'lost the daemon: {err}')
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                self.set_connected(False)
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+
+            if not self.stopped:
+                time.sleep(backoff)
+
+    def listen(self):
+        family, address = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.read_timeout)
+        sock.connect(address)
+        if family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+
+        state = None
+        seq = None
+        buffer = b''
+        while not self.stopped:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+
+                if 'state' in message:
+                    state = message['state']
+                    sections = list(state)
+                    self.log('following the daemon')
+                    self.set_connected(True)
+                elif message['seq'] != seq + 1:
+                    # shouldn't happen over a stream socket, but a missed change would leave us out of date for good
+                    raise ValueError('missed an update from the daemon')
+                else:
+                    changes = message['changes']
+                    state = patch(state, changes)
+                    sections = list(state) if any(not path for path, *_ in changes) else \
+                        list(dict.fromkeys(path[0] for path, *_ in changes))
+                seq = message['seq']
+
+                # copied, since later changes are patched into this state on this thread while the dashboard uses it
+                for section in sections:
+                    if section in state:
+                        self.on_update((section, copy.deepcopy(state[section])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fetches weather and lights once for many dashboards')
+    parser.add_argument('--listen', default=cfg.get('daemon-listen', default_address),
+                        help='host:port, or unix:/path for a Unix socket')
+    args = parser.parse_args()
+
+    os.makedirs('cache', exist_ok=True)
+    # the same request settings as a dashboard on its own
+    easy_requests.client.configure(connect_timeout=cfg.get('connect-timeout', None),
+                                   read_timeout=cfg.get('read-timeout', None),
+                                   retries=cfg.get('request-retries', None))
+    for prefix, replacement in cfg.get('url-rewrites', {}).items():
+        easy_requests.client.rewrite(prefix, replacement)
+    if cfg.get('daemon-metrics-port', None):
+        metrics.serve(cfg.get('daemon-metrics-port'), cfg.get('metrics-host', '127.0.0.1'))
+    Daemon(args.listen).run()
+
+
+if __name__ == '__main__':
+    main()
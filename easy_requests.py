@@ -1,18 +1,335 @@
-import urllib.request
+import base64
+import gzip
+import hashlib
+import http.client
+import io
 import json
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit, urljoin, parse_qsl, urlencode
 
+from files import atomic_write
+import metrics
 
-def get(url, content_type='application/json'):
-    r = urllib.request.Request(url,
-                                 headers={'User-Agent': 'Overseer Dashboard'})
-    if content_type == 'application/json':
-        return json.loads(urllib.request.urlopen(r).read().decode('utf-8'))
+# network errors that are worth trying again on a fresh connection
+retryable_errors = (OSError, http.client.HTTPException)
+retryable_statuses = (502, 503, 504)
+redirect_statuses = (301, 302, 303, 307, 308)
+# query parameters that are never written into recordings
+secret_params = ('APPID', 'appid')
+# headers that describe how a response was sent rather than what it was, so they aren't recorded
+unrecorded_headers = ('content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive')
+
+request_seconds = metrics.Histogram('dashboard_http_request_seconds',
+                                    'How long each HTTP round trip took, retries are counted separately', ['host'])
+responses_total = metrics.Counter('dashboard_http_responses_total',
+                                  'HTTP responses by status, or "error" if none came back', ['host', 'status'])
+
+
+class Response:
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+
+def recording_key(url):
+    # which recording a url is saved under, secrets are left out and http/https are treated the same
+    parts = urlsplit(url)
+    query = urlencode([(name, 'redacted' if name in secret_params else value)
+                       for name, value in parse_qsl(parts.query, keep_blank_values=True)])
+    return f'{parts.netloc}{parts.path or "/"}' + (f'?{query}' if query else '')
+
+
+# saves every response to disk, or answers requests from those saved responses without touching the network,
+# so anything built on this client can be run and timed repeatably
+class Recorder:
+    def __init__(self, directory, replaying=False):
+        self.directory = directory
+        self.replaying = replaying
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, method, url):
+        name = hashlib.sha1(f'{method} {recording_key(url)}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{name}.json')
+
+    def save(self, method, url, res):
+        recording = {
+            'method': method,
+            'url': recording_key(url),
+            'recorded-at': time.time(),
+            'status': res.status,
+            'headers': [[name, value] for name, value in res.headers.items()
+                        if name.lower() not in unrecorded_headers]
+        }
+        try:
+            recording['body'] = res.body.decode('utf-8')
+        except UnicodeDecodeError:
+            recording['body-base64'] = base64.b64encode(res.body).decode('ascii')
+
+        atomic_write(self.path(method, url), json.dumps(recording, indent=1))
+
+    def load(self, method, url):
+        try:
+            with open(self.path(method, url)) as file:
+                recording = json.load(file)
+        except OSError:
+            raise URLError(f'no recorded response for {method} {url}')
+        return recording_response(url, recording)
+
+
+def recording_response(url, recording):
+    headers = http.client.HTTPMessage()
+    for name, value in recording['headers']:
+        headers[name] = value
+    if 'body' in recording:
+        body = recording['body'].encode('utf-8')
     else:
-        return urllib.request.urlopen(r).read()
+        body = base64.b64decode(recording['body-base64'])
+    return Response(url, recording['status'], headers, body)
+
+
+class LatencyStats:
+    def __init__(self, samples=100):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_ms = 0
+        self.min_ms = None
+        self.max_ms = None
+        self.recent = deque(maxlen=samples)
+
+    def record(self, ms):
+        self.count += 1
+        self.total_ms += ms
+        self.min_ms = ms if self.min_ms is None else min(self.min_ms, ms)
+        self.max_ms = ms if self.max_ms is None else max(self.max_ms, ms)
+        self.recent.append(ms)
+
+    def percentile(self, p):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'retries': self.retries,
+            'avg-ms': self.total_ms / self.count if self.count else None,
+            'min-ms': self.min_ms,
+            'max-ms': self.max_ms,
+            'p50-ms': self.percentile(0.5),
+            'p95-ms': self.percentile(0.95),
+        }
+
+
+# a small HTTP/1.1 client that keeps connections to each host open between requests. it's safe to share
+# between threads, each request checks a connection out of the pool and puts it back when it's done with it
+class Session:
+    def __init__(self, connect_timeout=5, read_timeout=15, retries=2, max_idle_per_host=4,
+                 user_agent='Overseer Dashboard'):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.max_idle_per_host = max_idle_per_host
+        self.user_agent = user_agent
+        self.idle = {}  # (scheme, host, port) -> idle connections
+        self.stats = {}  # host -> LatencyStats
+        self.lock = threading.Lock()
+        self.recorder = None
+        self.rewrites = []  # (url prefix, what to send it to instead)
+
+    def configure(self, connect_timeout=None, read_timeout=None, retries=None):
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
+        if retries is not None:
+            self.retries = retries
+
+    def record(self, directory):
+        self.recorder = Recorder(directory)
+
+    def replay(self, directory):
+        self.recorder = Recorder(directory, replaying=True)
+
+    def rewrite(self, prefix, replacement):
+        # sends anything under a url to somewhere else, like a local stand-in server
+        self.rewrites.append((prefix, replacement))
+
+    def get(self, url, content_type='application/json', idempotent=True):
+        res = self.request('GET', url, idempotent=idempotent)
+        if content_type == 'application/json':
+            return res.json()
+        else:
+            return res.body
+
+    def post(self, url, post_json):
+        return self.request('POST', url, json.dumps(post_json).encode('utf8'),
+                            {'content-type': 'application/json'}).body
+
+    def request(self, method, url, body=None, headers=None, redirects=5, idempotent=None):
+        # idempotent is whether the request is safe to send twice, by default only GETs and HEADs are. some
+        # GETs change things, like overseer's toggles, and shouldn't be retried unless they certainly weren't sent
+        if self.recorder is not None and self.recorder.replaying:
+            res = self.recorder.load(method, url)
+        else:
+            sent_url = url
+            for prefix, replacement in self.rewrites:
+                if url.startswith(prefix):
+                    sent_url = replacement + url[len(prefix):]
+                    break
+            res = self.send(method, sent_url, body, headers, redirects, idempotent)
+            res.url = url
+            if self.recorder is not None:
+                self.recorder.save(method, url, res)
+
+        if res.status >= 400:
+            raise HTTPError(url, res.status, http.client.responses.get(res.status, ''), res.headers,
+                            io.BytesIO(res.body))
+        return res
+
+    def send(self, method, url, body=None, headers=None, redirects=5, idempotent=None):
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD')
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        all_headers = {
+            'User-Agent': self.user_agent,
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+        }
+        all_headers.update(headers or {})
+
+        stats = self.get_host_stats(parts.hostname)
+        attempt = 0
+        while True:
+            conn, reused = self._acquire(key)
+            start = time.perf_counter()
+            sent = False
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(self.read_timeout)
+                conn.request(method, path, body, all_headers)
+                sent = True
+                res = conn.getresponse()
+                res_body = res.read()
+            except retryable_errors as err:
+                conn.close()
+                # a kept-alive connection the server already hung up on isn't really a failed attempt, it either
+                # failed to send or was closed without an answer. anything else (like a timeout waiting for the
+                # response) is only retried for requests that are safe to send twice
+                stale = reused and (not sent or isinstance(err, http.client.RemoteDisconnected))
+                can_retry = stale or idempotent
+                if can_retry and attempt < self.retries:
+                    attempt += 1
+                    with self.lock:
+                        stats.retries += 1
+                    if not stale:
+                        time.sleep(0.2 * attempt)
+                    continue
+                with self.lock:
+                    stats.errors += 1
+                responses_total.inc(host=parts.hostname, status='error')
+                raise URLError(err)
+
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stats.record(elapsed * 1000)
+            request_seconds.observe(elapsed, host=parts.hostname)
+            responses_total.inc(host=parts.hostname, status=res.status)
+
+            if res.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+
+            # a server that says when to come back is left alone until then, rather than asked again right away
+            if res.status in retryable_statuses and not res.getheader('Retry-After') and idempotent \
+                    and attempt < self.retries:
+                attempt += 1
+                with self.lock:
+                    stats.retries += 1
+                time.sleep(0.2 * attempt)
+                continue
+            break
+
+        location = res.getheader('Location')
+        if res.status in redirect_statuses and location and redirects > 0:
+            return self.send('GET' if res.status == 303 else method, urljoin(url, location), body, headers,
+                             redirects - 1, idempotent)
+
+        encoding = res.getheader('Content-Encoding', '').lower()
+        if encoding == 'gzip':
+            res_body = gzip.decompress(res_body)
+        elif encoding == 'deflate':
+            res_body = zlib.decompress(res_body)
+
+        if res.status >= 400:
+            with self.lock:
+                stats.errors += 1
+        return Response(url, res.status, res.headers, res_body)
+
+    def get_host_stats(self, host):
+        with self.lock:
+            if host not in self.stats:
+                self.stats[host] = LatencyStats()
+            return self.stats[host]
+
+    def get_stats(self):
+        with self.lock:
+            return {host: stats.summary() for host, stats in self.stats.items()}
+
+    def close(self):
+        with self.lock:
+            pools, self.idle = self.idle, {}
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+
+    def _acquire(self, key):
+        with self.lock:
+            pool = self.idle.get(key)
+            if pool:
+                return pool.pop(), True
+
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.connect_timeout), False
+        return http.client.HTTPConnection(host, port, timeout=self.connect_timeout), False
+
+    def _release(self, key, conn):
+        with self.lock:
+            pool = self.idle.setdefault(key, [])
+            if len(pool) < self.max_idle_per_host:
+                pool.append(conn)
+                return
+        conn.close()
+
+
+# everything talks through this one client so connections to each host get reused
+client = Session()
+metrics.add_status('http', client.get_stats)
+
+
+def get(url, content_type='application/json', idempotent=True):
+    return client.get(url, content_type, idempotent)
 
 
 def post(url, post_json):
-    req = urllib.request.Request(url,
-                                 data=json.dumps(post_json).encode('utf8'),
-                                 headers={'content-type': 'application/json'})
-    return urllib.request.urlopen(req).read()
+    return client.post(url, post_json)
@@ -0,0 +1,12 @@
+import os
+
+
+def atomic_write(path, data):
+    # writes to a temporary file, flushes it to disk and then renames it over the old one, so a crash or a power
+    # cut leaves either the old file or the whole new one, never half of it
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
@@ -0,0 +1,186 @@
+from bisect import bisect_left
+from datetime import datetime
+
+from pretty import pretty_temp, pretty_weekday, pretty_date_str, pretty_length
+
+# pick an icon for a day based on its most frequent weather, eventually this can be more detailed with
+# better daily summaries
+day_icons = {
+    'Rain': '10d',
+    'Snow': '13d',
+    'Drizzle': '09d',
+    'Thunderstorm': '11d',
+    'Clear': '01d',
+    'Clouds': '03d'
+}
+
+
+# lazy values can legitimately be None, so this marks ones that haven't been worked out yet
+unset = object()
+
+
+def lazy(fn):
+    # a property that's only worked out the first time it's used, then kept in the '_<name>' slot
+    slot = f'_{fn.__name__}'
+
+    def get(self):
+        value = getattr(self, slot, unset)
+        if value is unset:
+            value = fn(self)
+            object.__setattr__(self, slot, value)
+        return value
+
+    return property(get)
+
+
+def pretty_precip(inches, precip_type):
+    return f'{pretty_length(inches)} {precip_type}' if inches else None
+
+
+# periods and days are shared between threads and every part of the UI, so they can't be changed once they're made
+class Frozen:
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} can\'t be changed once it\'s made')
+
+
+class Period(Frozen):
+    __slots__ = ('dt', 'days_from_now', 'temp', 'low', 'high', 'weather', 'weather_main', 'weather_id',
+                 'weather_icon', 'rain', 'snow',
+                 '_dt_pretty', '_temp_pretty', '_low_pretty', '_high_pretty', '_rain_pretty', '_snow_pretty')
+
+    def __init__(self, dt, days_from_now, temp, low, high, weather, weather_main, weather_id, weather_icon, rain,
+                 snow):
+        # there are a lot of these, so each field is set directly instead of looping over them
+        init = object.__setattr__
+        init(self, 'dt', dt)
+        init(self, 'days_from_now', days_from_now)
+        init(self, 'temp', temp)
+        init(self, 'low', low)
+        init(self, 'high', high)
+        init(self, 'weather', weather)
+        init(self, 'weather_main', weather_main)
+        init(self, 'weather_id', weather_id)
+        init(self, 'weather_icon', weather_icon)
+        # in inches
+        init(self, 'rain', rain)
+        init(self, 'snow', snow)
+
+    def with_range(self, low, high):
+        return Period(self.dt, self.days_from_now, self.temp, low, high, self.weather, self.weather_main,
+                      self.weather_id, self.weather_icon, self.rain, self.snow)
+
+    def counted_from(self, today):
+        # the same period with days_from_now worked out again, for after midnight
+        days_from_now = (self.dt - today).days
+        if days_from_now == self.days_from_now:
+            return self
+        return Period(self.dt, days_from_now, self.temp, self.low, self.high, self.weather, self.weather_main,
+                      self.weather_id, self.weather_icon, self.rain, self.snow)
+
+    def dump(self):
+        # a plain list for the startup snapshot, days_from_now is left out since it's only right on the day it's made
+        return [self.dt.timestamp(), self.temp, self.low, self.high, self.weather, self.weather_main, self.weather_id,
+                self.weather_icon, self.rain, self.snow]
+
+    @classmethod
+    def load(cls, values, today):
+        dt = datetime.fromtimestamp(values[0])
+        return cls(dt, (dt - today).days, *values[1:])
+
+    @lazy
+    def dt_pretty(self):
+        return pretty_date_str(self.dt)
+
+    @lazy
+    def temp_pretty(self):
+        return pretty_temp(self.temp)
+
+    @lazy
+    def low_pretty(self):
+        return pretty_temp(self.low)
+
+    @lazy
+    def high_pretty(self):
+        return pretty_temp(self.high)
+
+    @lazy
+    def rain_pretty(self):
+        return pretty_precip(self.rain, 'rain')
+
+    @lazy
+    def snow_pretty(self):
+        return pretty_precip(self.snow, 'snow')
+
+
+class Day(Frozen):
+    __slots__ = ('dt', 'low', 'high', 'rain', 'snow', 'weather', 'weather_icon', 'periods',
+                 '_dt_pretty', '_low_pretty', '_high_pretty', '_rain_pretty', '_snow_pretty')
+
+    def __init__(self, periods):
+        # totals for a day from its periods, which are kept as a tuple and shared rather than copied
+        mains = [period.weather_main for period in periods]
+        # get the weather type that's happening the most
+        weather = max(set(mains), key=mains.count)
+        init = object.__setattr__
+        init(self, 'dt', periods[0].dt.date())
+        init(self, 'low', min(period.low for period in periods))
+        init(self, 'high', max(period.high for period in periods))
+        init(self, 'rain', sum(period.rain for period in periods))
+        init(self, 'snow', sum(period.snow for period in periods))
+        init(self, 'weather', weather)
+        init(self, 'weather_icon', day_icons[weather])
+        init(self, 'periods', tuple(periods))
+
+    @lazy
+    def dt_pretty(self):
+        return pretty_weekday(self.dt)
+
+    @lazy
+    def low_pretty(self):
+        return pretty_temp(self.low)
+
+    @lazy
+    def high_pretty(self):
+        return pretty_temp(self.high)
+
+    @lazy
+    def rain_pretty(self):
+        return pretty_precip(self.rain, 'rain')
+
+    @lazy
+    def snow_pretty(self):
+        return pretty_precip(self.snow, 'snow')
+
+
+# when rain or snow is next expected over the forecast, so it can be looked up with a binary search instead of
+# scanning every period. periods need to be in time order, which is how openweather sends them
+class PrecipTimeline:
+    def __init__(self, periods, precip_type):
+        self.times = [period.dt for period in periods]
+        # for each period, the index of the first one from there on with and without precipitation
+        self.next_wet = [None] * len(periods)
+        self.next_dry = [None] * len(periods)
+        wet = dry = None
+        for i in reversed(range(len(periods))):
+            if getattr(periods[i], precip_type) != 0:
+                wet = i
+            else:
+                dry = i
+            self.next_wet[i] = wet
+            self.next_dry[i] = dry
+
+    def next_start(self, after):
+        return self.next(self.next_wet, after)
+
+    def next_stop(self, after):
+        return self.next(self.next_dry, after)
+
+    def next(self, following, after):
+        # the first period at or after the time that has (or doesn't have) precipitation, if it already does
+        # that's the period's own time
+        i = bisect_left(self.times, after)
+        if i == len(self.times) or following[i] is None:
+            return None
+        return self.times[following[i]]
@@ -0,0 +1,77 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage, QPainter
+
+import easy_requests
+
+# every icon openweather uses, a day and night variant of each condition
+icon_names = [f'{code}{time_of_day}' for code in ['01', '02', '03', '04', '09', '10', '11', '13', '50']
+              for time_of_day in ['d', 'n']]
+icon_indexes = {icon_name: i for i, icon_name in enumerate(icon_names)}
+# every size icons get shown at, None is the size they're downloaded at
+bundle_sizes = [None, 75, 50]
+full_size = 100
+manifest_path = 'cache/icons.json'
+
+
+def bundle_path(size):
+    return f'cache/icons-{size or "full"}.png'
+
+
+# all of the icons are downloaded once and stored as one strip of icons per size, so nothing needs to be
+# downloaded or scaled while the weather is being refreshed or shown
+class IconBundle:
+    def __init__(self):
+        self.available = set()
+
+    def has(self, icon_name):
+        return icon_name in self.available
+
+    def index(self, icon_name):
+        return icon_indexes[icon_name]
+
+    def load(self):
+        try:
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return False
+
+        if manifest.get('names') != icon_names or not all(path.exists(bundle_path(size)) for size in bundle_sizes):
+            return False
+
+        self.available = set(icon_names)
+        return True
+
+    def prefetch(self):
+        # doesn't touch any widgets, so this can be run off the GUI thread
+        if self.load():
+            return
+
+        with ThreadPoolExecutor(max_workers=8, thread_name_prefix='icon-fetch') as pool:
+            images = list(pool.map(self.download, icon_names))
+
+        for size in bundle_sizes:
+            cell = size or full_size
+            strip = QImage(cell * len(images), cell, QImage.Format_ARGB32)
+            strip.fill(Qt.transparent)
+            painter = QPainter(strip)
+            for i, image in enumerate(images):
+                painter.drawImage(i * cell, 0, image.scaled(cell, cell, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+            painter.end()
+            strip.save(bundle_path(size))
+
+        # written last, the bundle only counts as complete once this exists
+        with open(manifest_path, 'w') as file:
+            json.dump({'names': icon_names}, file)
+        self.available = set(icon_names)
+
+    def download(self, icon_name):
+        return QImage.fromData(
+            easy_requests.get(f'http://openweathermap.org/img/wn/{icon_name}@2x.png', 'image/png'))
+
+
+icon_bundle = IconBundle()
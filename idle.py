@@ -0,0 +1,131 @@
+import time
+
+from PyQt5.QtCore import QObject, QEvent, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QApplication
+
+import metrics
+
+try:
+    import resource
+except ImportError:
+    # windows doesn't have it, context switches just aren't counted there
+    resource = None
+
+# anything that means someone's at the screen
+input_events = frozenset([QEvent.MouseButtonPress, QEvent.MouseButtonDblClick, QEvent.MouseMove, QEvent.TouchBegin,
+                          QEvent.KeyPress, QEvent.Wheel])
+# the ones that should only wake the dashboard up, not also press whatever's under them
+wake_events = frozenset([QEvent.MouseButtonPress, QEvent.MouseButtonDblClick, QEvent.MouseButtonRelease,
+                         QEvent.TouchBegin, QEvent.TouchUpdate, QEvent.TouchEnd, QEvent.KeyPress, QEvent.Wheel])
+
+mode_seconds = metrics.Counter('dashboard_mode_seconds_total', 'Time spent awake and idle', ['mode'])
+cpu_seconds = metrics.Counter('dashboard_cpu_seconds_total', 'CPU time used while awake and idle', ['mode'])
+timer_events = metrics.Counter('dashboard_timer_events_total', 'Qt timers that woke up the GUI thread while awake '
+                                                               'and idle', ['mode'])
+context_switches = metrics.Counter('dashboard_context_switches_total', 'Times any thread gave up or was taken off '
+                                                                       'the CPU while awake and idle', ['mode'])
+
+
+def count_context_switches():
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_nvcsw + usage.ru_nivcsw
+
+
+# notices when nobody's touched the screen for a while. changed is emitted with True when it goes idle, and False
+# when something wakes it up again. it also keeps track of how much CPU time and how many wakeups each mode costs
+class IdleMonitor(QObject):
+    changed = pyqtSignal(bool)
+
+    def __init__(self, idle_after, parent=None):
+        super().__init__(parent)
+        self.idle_after = idle_after  # seconds, or None to never go idle
+        self.idle = False
+        self.last_reset = 0
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.go_idle)
+        self.timer_events = 0
+        # mode -> [seconds, cpu seconds, timer events, context switches]
+        self.totals = {'awake': [0, 0, 0, 0], 'idle': [0, 0, 0, 0]}
+        self.mode_started = self.sample()
+        # keeps the numbers current while it stays in one mode for hours, it's 6 wakeups an hour
+        self.account_timer = QTimer(self)
+        self.account_timer.timeout.connect(self.account)
+        self.account_timer.start(10 * 60 * 1000)
+
+    def start(self):
+        # every event in the app goes through eventFilter, so touches on dialogs count too
+        app = QApplication.instance()
+        app.installEventFilter(self)
+        app.aboutToQuit.connect(self.stop)
+        self.reset()
+
+    def stop(self):
+        # the filter has to come out before the app is destroyed, or the app can crash calling into it on the way out
+        QApplication.instance().removeEventFilter(self)
+        self.timer.stop()
+
+    def reset(self):
+        if self.idle_after:
+            self.timer.start(int(self.idle_after * 1000))
+        self.last_reset = time.monotonic()
+
+    def set_idle_after(self, idle_after):
+        self.idle_after = idle_after
+        if not idle_after:
+            self.timer.stop()
+        elif not self.idle:
+            self.reset()
+
+    def eventFilter(self, obj, event):
+        event_type = event.type()
+        if event_type == QEvent.Timer:
+            self.timer_events += 1
+        elif self.idle:
+            if event_type in input_events or event_type in wake_events:
+                self.wake()
+                return event_type in wake_events
+        elif event_type in input_events and time.monotonic() - self.last_reset > 1:
+            # restarting the timer on every mouse move would be a waste, once a second is plenty
+            self.reset()
+        return False
+
+    def go_idle(self):
+        self.account()
+        self.idle = True
+        self.changed.emit(True)
+
+    def wake(self):
+        self.account()
+        self.idle = False
+        self.reset()
+        self.changed.emit(False)
+
+    def sample(self):
+        return [time.monotonic(), time.process_time(), self.timer_events, count_context_switches()]
+
+    def account(self):
+        # adds what the current mode has cost since it was last accounted for
+        now = self.sample()
+        mode = 'idle' if self.idle else 'awake'
+        deltas = [after - before for after, before in zip(now, self.mode_started)]
+        self.totals[mode] = [total + delta for total, delta in zip(self.totals[mode], deltas)]
+        for counter, delta in zip([mode_seconds, cpu_seconds, timer_events, context_switches], deltas):
+            counter.inc(delta, mode=mode)
+        self.mode_started = now
+
+    def status(self):
+        # what each mode costs per hour, for the /status page. this is called from the metrics server's thread, so
+        # it only reads the totals, which are at most ten minutes behind
+        status = {'mode': 'idle' if self.idle else 'awake'}
+        for mode, (seconds, cpu, timers, switches) in self.totals.items():
+            hours = seconds / 3600
+            status[mode] = {
+                'hours': round(hours, 2),
+                'cpu-seconds-per-hour': round(cpu / hours, 2) if hours else None,
+                'timer-wakeups-per-hour': round(timers / hours) if hours else None,
+                'context-switches-per-hour': round(switches / hours) if hours else None
+            }
+        return status
@@ -1,46 +1,349 @@
+import hashlib
+import http.client
+import json
+import random
+import socket
 import sys
-from urllib.error import URLError
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError, HTTPError
+from urllib.parse import urlsplit
 
 import easy_requests
-from config_reader import ConfigReader
+import metrics
+from config_reader import cfg
 
-cfg = ConfigReader()
+# for sending toggles side by side to overseer versions that can't change many lights in one request
+toggle_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='light-toggle')
+polls_total = metrics.Counter('dashboard_light_polls_total', 'Polls of overseer\'s lights by whether anything changed',
+                              ['result'])
+events_total = metrics.Counter('dashboard_light_events_total', 'Updates received from overseer\'s light stream')
 
 
 class Lights:
     def __init__(self):
-        self.overseer_url = f'http://{cfg.get("overseer")}/'
         self.lights = []
-        self.refresh()
+        # bumped whenever the lights change other than by a poll, so a poll that was already on its way can tell
+        # that what it got back is out of date
+        self.generation = 0
+        self.configure()
+
+    def configure(self):
+        # run again when overseer's address changes in config.json, everything learned about the old one is
+        # forgotten so the next fetch isn't mistaken for an unchanged one
+        self.overseer_url = f'http://{cfg.get("overseer")}/'
+        # what the last fetch returned, so polls that don't change anything can be skipped
+        self.etag = None
+        self.digest = None
+        # None until we know whether overseer has lights/bulk
+        self.bulk_supported = None
 
     def log(self, msg):
         print(f'[lights] {msg}')
 
-    def refresh(self, data=None):
+    def fetch(self):
+        # network only, so it's safe to call off the GUI thread and hand the result to refresh(). returns the
+        # lights and the generation they were fetched at, or None if they're the same as they were the last time
+        generation = self.generation
+        headers = {'If-None-Match': self.etag} if self.etag else {}
+        with metrics.timed('lights.fetch'):
+            res = easy_requests.client.request('GET', f'{self.overseer_url}lights/info', headers=headers)
+        if res.status == 304:
+            polls_total.inc(result='unchanged')
+            return None
+
+        # not every overseer version sends an ETag, so compare the contents too
+        digest = hashlib.sha1(res.body).hexdigest()
+        if digest == self.digest:
+            polls_total.inc(result='unchanged')
+            return None
+
+        polls_total.inc(result='changed')
+        self.etag = res.headers.get('ETag')
+        self.digest = digest
+        return res.json(), generation
+
+    def forget_poll(self):
+        # the lights were changed some other way, so what the last poll returned no longer matches what's shown.
+        # the next poll can't be skipped even if overseer sends the same thing again, and one that's already on
+        # its way is out of date
+        self.etag = None
+        self.digest = None
+        self.generation += 1
+
+    def refresh(self, data=None, generation=None):
+        # returns whether anything was applied. generation is the one fetch() returned, for data from a poll
         try:
-            if not data:
-                data = easy_requests.get(f'{self.overseer_url}lights/info')
+            if data is None:
+                polled = self.fetch()
+                if polled is None:
+                    return False
+                data, generation = polled
 
             if 'error' in data:
                 self.log('error retrieving lights information, does overseer trust this device?')
                 sys.exit(-1)
 
+            if generation is not None and generation != self.generation:
+                # the lights were changed while the poll was on its way, showing what it got would undo that. what
+                # fetch() kept to skip the next poll is just as out of date
+                self.log('dropping a poll that started before the lights last changed')
+                self.forget_poll()
+                return False
+
             self.lights = data
+            if generation is None:
+                self.forget_poll()
+            return True
         except URLError as err:
             self.log('error reaching overseer')
             self.log(err)
+            return False
 
     def get_lights(self):
         return self.lights
 
-    def toggle(self, light_id):
+    def get_light(self, light_id):
+        light_id = str(light_id)
+        return next((light for light in self.lights if light['id'] == light_id), None)
+
+    def set_on(self, light_id, on):
+        light = self.get_light(light_id)
+        if light is not None:
+            light['on'] = on
+            self.forget_poll()
+
+    def apply_event(self, data):
+        # applies an update from the light stream, returning the ids of the lights that changed
+        events_total.inc()
+        if isinstance(data, list):
+            before = {light['id']: light['on'] for light in self.lights}
+            self.refresh(data)
+            return [light['id'] for light in self.lights if before.get(light['id']) != light['on']]
+        elif isinstance(data, dict) and 'id' in data and 'on' in data:
+            light = self.get_light(data['id'])
+            if light is not None and light['on'] != data['on']:
+                light['on'] = data['on']
+                self.forget_poll()
+                return [light['id']]
+        return []
+
+    def get_scenes(self):
+        # named sets of light states from config.json, like {"Evening": {"1": true, "2": false}}
+        return cfg.get('scenes', {})
+
+    def get_changes(self, states):
+        # only the lights that aren't already in the state they're being asked to be in
+        changes = {}
+        for light_id, on in states.items():
+            light = self.get_light(light_id)
+            if light is not None and light['on'] != on:
+                changes[light['id']] = on
+        return changes
+
+    def set_many(self, states):
+        # turns lights (light id -> on) on or off in one request, or toggles them side by side on older overseer
+        # versions. network only so it's safe to call off the GUI thread, hand the result to apply_set_many().
+        changes = self.get_changes(states)
+        if not changes:
+            return {}, None
+
+        self.log(f'setting {len(changes)} lights')
+        with metrics.timed('lights.set_many'):
+            return self.send_changes(changes)
+
+    def send_changes(self, changes):
+        if self.bulk_supported is not False:
+            try:
+                res = easy_requests.client.post(f'{self.overseer_url}lights/bulk',
+                                                [{'id': light_id, 'on': on} for light_id, on in changes.items()])
+                self.bulk_supported = True
+                data = json.loads(res.decode('utf-8'))
+                if 'error' in data:
+                    self.log(f'Error setting lights: {data["error"]}')
+                    return {}, None
+                return changes, data
+            except HTTPError as err:
+                if err.code not in (404, 405):
+                    raise
+                self.log('overseer can\'t set many lights at once, toggling them one at a time')
+                self.bulk_supported = False
+
+        applied = {}
+        light_ids = list(changes)
+        for light_id, res in zip(light_ids, toggle_pool.map(self.send_toggle, light_ids)):
+            if 'error' in res:
+                self.log(f'Error toggling lights: {res["error"]}')
+            else:
+                applied[light_id] = changes[light_id]
+        return applied, None
+
+    def apply_set_many(self, result):
+        applied, data = result
+        # newer overseer versions respond to bulk changes with every light's state
+        if isinstance(data, list):
+            self.refresh(data)
+        else:
+            for light_id, on in applied.items():
+                self.set_on(light_id, on)
+
+    def stream(self, on_event, on_status):
+        return LightStream(f'{self.overseer_url}lights/events', on_event, on_status)
+
+    def send_toggle(self, light_id):
         # since IDs are numbers as strings, it's easy to forget to pass a string, ensure we're dealing with a string
         light_id = str(light_id)
-        light_name = next(light['name'] for light in self.lights if light['id'] == light_id)
+        light_name = self.get_light(light_id)['name']
 
         self.log(f'toggling {light_id} ({light_name})')
-        res = easy_requests.get(f'{self.overseer_url}lights/toggle/{light_id}')
-        if 'error' in res:
-            self.log(f'Error toggling lights: {res["error"]}')
+        with metrics.timed('lights.toggle'):
+            # a toggle sent twice is no toggle at all, so it's never retried
+            return easy_requests.get(f'{self.overseer_url}lights/toggle/{light_id}', idempotent=False)
+
+    def apply_toggle_response(self, light_id, res):
+        # some versions of overseer respond with the new state, when they do there's no need to refresh everything
+        if isinstance(res, list):
+            self.refresh(res)
+            return True
+        elif isinstance(res, dict) and 'on' in res:
+            self.set_on(light_id, res['on'])
+            return True
+        return False
+
+
+# decides how long to wait between light polls while there's no light stream. polls are quick for a while after
+# someone uses the dashboard, and back off exponentially for as long as nothing changes, so an empty room at 3am
+# is barely polled at all. there's some jitter so a building full of dashboards don't all poll at the same moment
+class PollSchedule:
+    def __init__(self, base=10, fast=2, slowest=120, backoff=2, active_period=60, jitter=0.1):
+        self.base = base
+        self.fast = fast
+        self.slowest = slowest
+        self.backoff = backoff
+        self.active_period = active_period
+        self.jitter = jitter
+        self.interval = base
+        self.active_until = 0
+
+    def interacted(self):
+        self.active_until = time.monotonic() + self.active_period
+
+    def polled(self, changed):
+        if changed:
+            self.interval = self.base
         else:
-            self.refresh()
+            self.interval = min(self.interval * self.backoff, self.slowest)
+
+    def next_delay(self):
+        # in seconds
+        interval = self.fast if time.monotonic() < self.active_until else self.interval
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+# follows overseer's server-sent light events on its own thread, so changes made elsewhere show up immediately
+# instead of on the next poll. on_event is called with each event's data (the full light list or a single light),
+# and on_status with whether the stream is currently connected, so polling can take over while it isn't
+class LightStream:
+    def __init__(self, url, on_event, on_status, read_timeout=90, max_backoff=60, unsupported_backoff=60 * 10,
+                 stable_after=30):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path
+        self.on_event = on_event
+        self.on_status = on_status
+        # overseer sends a comment every so often to keep the stream alive, if nothing shows up in this long it's gone
+        self.read_timeout = read_timeout
+        self.max_backoff = max_backoff
+        # older overseer versions don't have a stream at all, there's no point checking for one very often
+        self.unsupported_backoff = unsupported_backoff
+        # a stream that ends before it's sent anything or stayed up this long wasn't really up, something in the
+        # way (a proxy, or an overseer that's struggling) is likely to do the same thing again
+        self.stable_after = stable_after
+        self.events = 0  # received since the stream last connected
+        self.connected = False
+        self.stopped = False
+        self.conn = None
+        self.thread = threading.Thread(target=self.run, name='light-stream', daemon=True)
+
+    def log(self, msg):
+        print(f'[lights] {msg}')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        conn = self.conn
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def set_connected(self, connected):
+        if connected != self.connected:
+            self.connected = connected
+            self.on_status(connected)
+
+    def run(self):
+        backoff = 1
+        while not self.stopped:
+            delay = backoff
+            started = time.monotonic()
+            try:
+                if not self.listen():
+                    delay = self.unsupported_backoff
+                elif self.events or time.monotonic() - started >= self.stable_after:
+                    # the stream was up before it ended, try to get it back quickly
+                    backoff = delay = 1
+                else:
+                    self.log('the light stream closed straight away')
+                    backoff = min(backoff * 2, self.max_backoff)
+            except (OSError, http.client.HTTPException, ValueError) as err:
+                if self.connected:
+                    self.log(f'lost the light stream: {err}')
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                self.set_connected(False)
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+
+            if not self.stopped:
+                time.sleep(delay)
+
+    def listen(self):
+        # returns False if overseer doesn't have a light stream
+        self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.read_timeout)
+        self.conn.request('GET', self.path, headers={
+            'User-Agent': 'Overseer Dashboard',
+            'Accept': 'text/event-stream',
+            'Cache-Control': 'no-cache'
+        })
+        res = self.conn.getresponse()
+        if res.status != 200 or not res.getheader('Content-Type', '').startswith('text/event-stream'):
+            self.log('overseer has no light stream, polling instead')
+            return False
+
+        self.log('following the light stream')
+        self.events = 0
+        self.set_connected(True)
+        data = []
+        while not self.stopped:
+            line = res.readline()
+            if not line:
+                return True
+            line = line.decode('utf-8').rstrip('\r\n')
+
+            if line == '':
+                # a blank line ends an event
+                if data:
+                    self.events += 1
+                    self.on_event(json.loads('\n'.join(data)))
+                    data = []
+            elif line.startswith('data:'):
+                data.append(line[5:].lstrip(' '))
+            # event names, ids and ':' keep-alive comments don't matter here
+        return True
@@ -1,16 +1,48 @@
 import errno
 import os
 import sys
+import time
+from bisect import bisect_left
 from datetime import datetime
 
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QTimer, Qt
 from PyQt5.QtWidgets import QApplication, QLabel, QVBoxLayout, QWidget, QPushButton, QSizePolicy, QMessageBox, \
     QScrollArea, QHBoxLayout, QScroller
 
-from lights import Lights
-from pretty import pretty_weekday, pretty_date_only_str, pretty_time_str, pretty_time_str_short
-from uibuilder import UIBuilder
-from weather import Weather
+import easy_requests
+import metrics
+import snapshot
+from background import BackgroundTask, ThreadSignal
+from config_reader import cfg
+from daemon import DaemonClient
+from icons import icon_bundle
+from idle import IdleMonitor
+from lights import Lights, PollSchedule
+from pretty import pretty_length_of_time, pretty_weekday, pretty_date_only_str, pretty_time_str, pretty_time_str_short
+from reloader import FileWatcher
+from uibuilder import UIBuilder, pixmap_cache
+from watchdog import Watchdog
+from weather import Weather, configure_schedule, location_settings, retry_interval, schedule_settings, sources
+
+# startup is timed from here until the first frame is painted
+started = time.perf_counter()
+# the url rewrites that came from config.json, so a reload only replaces those and not ones added some other way
+config_rewrites = []
+
+
+def configure_requests():
+    client = easy_requests.client
+    client.configure(connect_timeout=cfg.get('connect-timeout', None),
+                     read_timeout=cfg.get('read-timeout', None),
+                     retries=cfg.get('request-retries', None))
+    # for pointing the dashboard at stand-in servers, like tools/replay_server.py
+    rewrites = list(cfg.get('url-rewrites', {}).items())
+    client.rewrites = [rewrite for rewrite in client.rewrites if rewrite not in config_rewrites] + rewrites
+    config_rewrites[:] = rewrites
+
+
+configure_requests()
+widgets_touched_total = metrics.Counter('dashboard_ui_widgets_touched_total', 'Widgets changed by weather refreshes')
 
 # icon cache directory
 try:
@@ -19,27 +51,36 @@ except OSError as e:
     if e.errno != errno.EEXIST:
         raise
 
-with open('styles.css', 'r') as file:
-    default_styles = file.read()
+
+def read_styles():
+    with open('styles.css', 'r') as file:
+        return file.read()
+
+
+default_styles = read_styles()
 forecast_day_template = """
                 QPushButton#forecast-day-{i}-details(expanding=true,style=height:150px;)
                     QVBoxLayout
-                        QLabel#forecast-day-{i}
-                        QLabel#forecast-day-{i}-icon
+                        QLabel#forecast-day-{i}(bind=day.{i}.dt)
+                        QLabel#forecast-day-{i}-icon(bind-icon=day.{i}.icon,icon-size=50)
                         QHBoxLayout
-                            QLabel#forecast-day-{i}-low.temperature
+                            QLabel#forecast-day-{i}-low.temperature(bind=day.{i}.low,bind-prop-temp-bucket=day.{i}.low-bucket)
                             QLabel -
-                            QLabel#forecast-day-{i}-high.temperature
+                            QLabel#forecast-day-{i}-high.temperature(bind=day.{i}.high,bind-prop-temp-bucket=day.{i}.high-bucket)
                             stretch
-                        QLabel#forecast-day-{i}-conditions
+                        QLabel#forecast-day-{i}-conditions(bind=day.{i}.weather)
                         //like the upcoming precip for today, we could have one or both types of precip, don't leave a gap
-                        QLabel#forecast-day-{i}-precip-rain
-                        QLabel#forecast-day-{i}-precip-snow
+                        QLabel#forecast-day-{i}-precip-rain(bind=day.{i}.rain)
+                        QLabel#forecast-day-{i}-precip-snow(bind=day.{i}.snow)
                         stretch
 """
 
+scene_button_template = """
+QPushButton#scene-{i}(expanding=true)
+"""
+
 periods_detail_template = """
-QGroupBox(detail-group=true)
+QGroupBox#period-{i}(detail-group=true)
     QVBoxLayout
         QHBoxLayout
             QLabel#time-{i}
@@ -51,78 +92,141 @@ QGroupBox(detail-group=true)
         stretch
 """
 
+# how many days after today get a spot on the dashboard, longer forecasts are only kept for their details
+forecast_day_count = 5
+
+# settings in config.json that can be changed while the dashboard is running, by what they affect. anything else
+# is only read at startup
+request_settings = {'connect-timeout', 'read-timeout', 'request-retries', 'url-rewrites'}
+overseer_settings = {'overseer', 'light-stream'}
+idle_settings = {'idle-after', 'idle-display', 'backlight', 'wake-latency-target'}
+watchdog_settings = {'watchdog', 'watchdog-interval', 'watchdog-threshold'}
+live_settings = request_settings | location_settings | schedule_settings | overseer_settings | idle_settings | \
+                watchdog_settings | {'scenes', 'light-poll-max'}
+
 
-def scale_template(template, times):
+def scale_template(template, times, start=0):
     temp = ''
-    for i in range(times):
+    for i in range(start, times):
         temp += template.replace('{i}', str(i))
     return temp
 
 
-def get_temperature_color(degrees):
-    if degrees > 100:
-        return 'cc006c'
-    elif degrees > 90:
-        return 'fe3300'
-    elif degrees > 80:
-        return 'fe6601'
-    elif degrees > 70:
-        return 'fe8a33'
-    elif degrees > 60:
-        return 'ffbf00'
-    elif degrees > 50:
-        return 'fdff00'
-    elif degrees > 40:
-        return '3fff6e'
-    elif degrees > 30:
-        return '34cbc6'
-    elif degrees > 20:
-        return '35cbcb'
-    elif degrees > 10:
-        return '009afe'
-    elif degrees > 0:
-        return '2f34c9'
-    elif degrees > -10:
-        return '6a00ce'
-    elif degrees > -20:
-        return '9901f6'
-    elif degrees > -30:
-        return 'cd98fe'
-    else:
-        return 'e3e1ed'
-
-
-def get_temp_color_stylesheet(temp):
-    return f'color: #{get_temperature_color(temp)};'
+# temperatures above each of these get the next colour up, the colours are matched by temp-bucket in styles.css
+temp_bucket_thresholds = [-30, -20, -10, 0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
+temp_buckets = [str(bucket) for bucket in range(len(temp_bucket_thresholds) + 1)]
+
+
+def get_temp_bucket(degrees):
+    return temp_buckets[bisect_left(temp_bucket_thresholds, degrees)]
 
 
 class Dashboard(QWidget):
     def __init__(self):
         super().__init__()
+        # downloading icons on a fresh install can happen at the same time as everything else
+        self.icons_task = BackgroundTask(icon_bundle.prefetch, self)
+        self.icons_task.finished.connect(self.on_icons_fetched)
+        self.icons_task.failed.connect(lambda err: print(f'[icons] error downloading icons, trying again after the '
+                                                         f'next weather update: {err}'))
+        if not icon_bundle.load():
+            self.icons_task.start()
+
         self.lights = Lights()
         self.weather = Weather()
+        # whatever was showing before a restart is painted right away, then caught up on in the background
+        self.snapshot = snapshot.load() or {}
+        self.snapshot_task = BackgroundTask(snapshot.save, self)
+        self.snapshot_task.failed.connect(lambda err: print(f'[snapshot] error saving snapshot: {err}'))
+        self.restore_snapshot()
+        self.first_frame_ms = None
+        self.weather_task = BackgroundTask(self.weather.fetch, self)
+        self.weather_task.finished.connect(self.on_weather_fetched)
+        self.weather_task.failed.connect(self.on_weather_failed)
+        self.lights_task = BackgroundTask(self.lights.fetch, self)
+        self.lights_task.finished.connect(self.on_lights_fetched)
+        self.lights_task.failed.connect(self.on_lights_failed)
         self.setObjectName('top-level')
-        with open('ui.txt') as file:
-            raw_ui = file.read()
-        raw_ui += scale_template(forecast_day_template, 5)
-        self.ui = UIBuilder(self, raw_ui)
+        self.ui = self.build_ui(self)
 
         self.update_time()  # set the time immediately
         self.light_buttons = {}
+        # light id -> the on state the user last tapped the light into, until overseer agrees with it
+        self.light_wanted = {}
+        self.light_toggle_timers = {}
+        self.light_toggle_tasks = {}
+        self.light_toggle_debounce = 250
+        self.scene_task = BackgroundTask(self.lights.set_many, self)
+        self.scene_task.finished.connect(self.on_lights_set)
+        self.scene_task.failed.connect(self.on_lights_set_failed)
+        self.scene_lights = set()  # lights a scene is being applied to
+        self.scene_names = None  # the scenes there are buttons for
         self.create_lights_ui()
         self.weather_box = None
+        # one reusable dialog for today and each forecast day, see prepare_forecast_details()
+        self.forecast_details = [ForecastDetails() for _ in range(forecast_day_count + 1)]
+        self.connect_weather_listeners()
+        self.weather_widgets_touched = 0
         self.update_weather_ui()
 
-        self.weather_update_timeout = 1000 * 300  # five minutes, weather reports only update every 10 minutes
-        self.light_refresh_timeout = 1000 * 10
-        self.interval(self.update_time, 1000)
-        self.interval(self.rebuild_weather, self.weather_update_timeout)
-        # poll every so often just in case the lights are changed elsewhere
-        self.interval(self.refresh_lights, self.light_refresh_timeout)
+        # after a while without anyone touching the screen it's dimmed or blanked, and everything that wakes up
+        # on a timer stops until someone does
+        self.idle = IdleMonitor(None, self)
+        self.idle.changed.connect(self.on_idle_changed)
+        metrics.add_status('power', self.idle.status)
+        self.clock_timer = self.interval(self.update_time, 1000)
+        # current conditions, the forecast and alerts are each fetched on their own schedule, this goes off
+        # whenever the next of them is due
+        self.weather_timer = QTimer(self)
+        self.weather_timer.setSingleShot(True)
+        self.weather_timer.timeout.connect(self.rebuild_weather)
+        metrics.add_status('weather', self.weather.status)
+        # poll every so often just in case the lights are changed elsewhere, unless overseer can tell us itself
+        self.light_poll_schedule = PollSchedule(slowest=cfg.get('light-poll-max', 120))
+        self.light_poll_timer = QTimer(self)
+        self.light_poll_timer.setSingleShot(True)
+        self.light_poll_timer.timeout.connect(self.refresh_lights)
+        self.light_events = ThreadSignal(self)
+        self.light_events.emitted.connect(self.on_light_event)
+        self.light_stream_status = ThreadSignal(self)
+        self.light_stream_status.emitted.connect(self.on_light_stream_status)
+        self.light_stream = None
+        # a daemon fetches everything once for every dashboard in the building, see daemon.py
+        self.daemon = None
+        if cfg.get('daemon', None):
+            self.daemon_updates = ThreadSignal(self)
+            self.daemon_updates.emitted.connect(self.on_daemon_update)
+            self.daemon_status = ThreadSignal(self)
+            self.daemon_status.emitted.connect(self.on_daemon_status)
+            self.daemon = DaemonClient(cfg.get('daemon'), self.daemon_updates.emit, self.daemon_status.emit)
+            self.daemon.start()
+        else:
+            self.start_light_stream()
+        self.schedule_light_poll()
+        # logs what the GUI thread was doing whenever it's blocked long enough to make the clock skip
+        self.watchdog = None
+        self.configure_watchdog()
+
+        self.idle_overlay = QWidget(self)
+        self.idle_overlay.setObjectName('idle-overlay')
+        self.idle_overlay.setAttribute(Qt.WA_StyledBackground, True)
+        self.idle_overlay.hide()
+        self.waking_since = None
+        self.waking_for = set()
+        self.configure_idle()
+
+        # edits to the layout, the styles and config.json are applied without a restart
+        self.file_watcher = None
+        if cfg.get('hot-reload', True):
+            self.file_watcher = FileWatcher(['ui.txt', 'styles.css', cfg.path], self)
+            self.file_watcher.changed.connect(self.on_file_changed)
 
         self.setStyleSheet(default_styles)
         self.setWindowTitle('Overseer Dashboard')
         self.show()
+        self.rebuild_weather()
+        self.refresh_lights()
+        self.idle.start()
 
         # can be run using 'start_fullscreen.sh' for touch screens
         if 'fullscreen' in sys.argv:
@@ -131,9 +235,305 @@ class Dashboard(QWidget):
             self.setMinimumWidth(800)
             self.setMinimumHeight(480)
 
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.first_frame_ms is None:
+            self.first_frame_ms = (time.perf_counter() - started) * 1000
+            metrics.phase_seconds.observe(self.first_frame_ms / 1000, phase='startup.first_frame')
+            if self.weather.is_stale():
+                shown = 'the snapshot'
+            else:
+                shown = 'live weather' if self.weather.has_weather() else 'no weather yet'
+            print(f'[startup] first frame painted after {self.first_frame_ms:.0f}ms, showing {shown}')
+
+    def build_ui(self, widget):
+        with open('ui.txt') as file:
+            raw_ui = file.read()
+        raw_ui += scale_template(forecast_day_template, forecast_day_count)
+        return UIBuilder(widget, raw_ui)
+
+    def on_file_changed(self, path):
+        if path == 'ui.txt':
+            self.reload_ui()
+        elif path == 'styles.css':
+            self.reload_styles()
+        else:
+            self.reload_config()
+
+    def reload_ui(self):
+        start = time.perf_counter()
+        # built off to the side first, so a mistake in ui.txt leaves the current layout alone
+        staging = QWidget()
+        try:
+            ui = self.build_ui(staging)
+        except Exception as err:
+            print(f'[reload] couldn\'t build ui.txt, keeping the current layout: {err}')
+            return
+
+        # the old layout and every widget in it go away with the throwaway widget they're moved onto. the weather
+        # and lights are already here, they're only shown again
+        self.light_buttons = {}
+        self.scene_names = None
+        QWidget().setLayout(self.layout())
+        self.setLayout(staging.layout())
+        ui.top = self
+        self.ui = ui
+        self.connect_weather_listeners()
+        self.update_time()
+        self.create_lights_ui()
+        self.update_weather_ui()
+        self.idle_overlay.raise_()
+        elapsed = time.perf_counter() - start
+        metrics.phase_seconds.observe(elapsed, phase='reload.ui')
+        print(f'[reload] rebuilt the layout from ui.txt in {elapsed * 1000:.0f}ms')
+
+    def reload_styles(self):
+        global default_styles
+        start = time.perf_counter()
+        try:
+            default_styles = read_styles()
+        except OSError as err:
+            print(f'[reload] couldn\'t read styles.css: {err}')
+            return
+        self.setStyleSheet(default_styles)
+        # the forecast dialogs are kept around, anything else picks up the new styles when it's opened
+        for details in self.forecast_details:
+            details.box.setStyleSheet(default_styles)
+        elapsed = time.perf_counter() - start
+        metrics.phase_seconds.observe(elapsed, phase='reload.styles')
+        print(f'[reload] applied styles.css in {elapsed * 1000:.0f}ms')
+
+    def reload_config(self):
+        changed = cfg.reload()
+        if not changed:
+            return
+        print(f'[reload] {cfg.path} changed {", ".join(sorted(changed))}')
+
+        # only what a setting affects is redone, the weather and lights that were already fetched are kept
+        if changed & request_settings:
+            configure_requests()
+        if changed & schedule_settings:
+            configure_schedule()
+        if changed & location_settings and self.daemon is None:
+            # everything fetched so far is for somewhere else
+            self.weather_task.start(list(sources))
+        if changed & overseer_settings:
+            self.lights.configure()
+            if self.daemon is None:
+                self.start_light_stream()
+            self.refresh_lights()
+        if 'scenes' in changed:
+            self.create_scenes_ui()
+        if 'light-poll-max' in changed:
+            self.light_poll_schedule.slowest = cfg.get('light-poll-max', 120)
+        if changed & idle_settings:
+            self.configure_idle()
+        if changed & watchdog_settings:
+            self.configure_watchdog()
+
+        restart_needed = changed - live_settings
+        if restart_needed:
+            print(f'[reload] restart the dashboard for changes to {", ".join(sorted(restart_needed))} to take effect')
+
+    def configure_idle(self):
+        self.idle.set_idle_after(cfg.get('idle-after', 10) * 60 or None)
+        blank = cfg.get('idle-display', 'dim') == 'blank'
+        if self.idle_overlay.property('blank') != blank:
+            self.idle_overlay.setProperty('blank', blank)
+            self.update_widget(self.idle_overlay)
+        self.backlight = cfg.get('backlight', None)  # like /sys/class/backlight/rpi_backlight, to turn it off too
+        # how long waking up can take to have fresh weather and lights, before it's logged as too slow
+        self.wake_latency_target = cfg.get('wake-latency-target', 1500)
+
+    def configure_watchdog(self):
+        if not cfg.get('watchdog', True):
+            if self.watchdog is not None:
+                self.watchdog.stop()
+                self.watchdog.deleteLater()
+                self.watchdog = None
+            return
+
+        if self.watchdog is None:
+            self.watchdog = Watchdog(self)
+        self.watchdog.interval = cfg.get('watchdog-interval', 100)
+        self.watchdog.threshold = cfg.get('watchdog-threshold', 250)
+        # restarted so the heartbeat picks up the new interval, it stays stopped while the screen's idle
+        self.watchdog.stop()
+        if not self.idle.idle:
+            self.watchdog.start()
+
+    def start_light_stream(self):
+        if self.light_stream is not None:
+            self.light_stream.stop()
+            self.light_stream = None
+        if cfg.get('light-stream', True):
+            self.light_stream = self.lights.stream(self.light_events.emit, self.light_stream_status.emit)
+            self.light_stream.start()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.idle_overlay.setGeometry(self.rect())
+
+    def on_idle_changed(self, idle):
+        if idle:
+            self.go_idle()
+        else:
+            self.wake()
+
+    def go_idle(self):
+        print(f'[idle] nobody\'s touched the screen in {pretty_length_of_time(self.idle.idle_after)}, going idle')
+        # a forecast or alert left open would stay lit up on top of everything
+        dialog = QApplication.activeModalWidget()
+        if dialog is not None:
+            dialog.reject()
+        self.idle_overlay.setGeometry(self.rect())
+        self.idle_overlay.raise_()
+        self.idle_overlay.show()
+        if self.idle_overlay.property('blank'):
+            self.set_backlight(False)
+
+        # the clock, polling and the watchdog's heartbeat are what wake the dashboard up all day, waking up
+        # catches up on anything that would have happened in the meantime. a light stream or daemon still
+        # sends changes, they're only waiting on a socket
+        self.clock_timer.stop()
+        self.weather_timer.stop()
+        self.light_poll_timer.stop()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+
+    def wake(self):
+        self.waking_since = time.perf_counter()
+        self.idle_overlay.hide()
+        self.set_backlight(True)
+        self.update_time()
+        self.clock_timer.start(1000)
+        if self.watchdog is not None:
+            self.watchdog.start()
+
+        # someone's here, so anything they change elsewhere should show up quickly too
+        self.light_poll_schedule.interacted()
+        self.rebuild_weather()
+        if not self.following_lights():
+            self.refresh_lights()
+        self.waking_for = {name for name, task in [('weather', self.weather_task), ('lights', self.lights_task)]
+                           if task.running}
+        self.woke_up_to_date()
+
+    def woke_up_to_date(self, name=None):
+        # called as each refresh started by waking up finishes, the last one times how long waking up took
+        if self.waking_since is None:
+            return
+        self.waking_for.discard(name)
+        if self.waking_for:
+            return
+
+        elapsed = time.perf_counter() - self.waking_since
+        self.waking_since = None
+        metrics.phase_seconds.observe(elapsed, phase='idle.wake')
+        slow = f', slower than the {self.wake_latency_target}ms target' if elapsed * 1000 > self.wake_latency_target \
+            else ''
+        print(f'[idle] awake and up to date in {elapsed * 1000:.0f}ms{slow}')
+
+    def set_backlight(self, on):
+        if self.backlight is None:
+            return
+        try:
+            with open(os.path.join(self.backlight, 'bl_power'), 'w') as file:
+                file.write('0' if on else '1')
+        except OSError as err:
+            print(f'[idle] couldn\'t turn the backlight {"on" if on else "off"}: {err}')
+
+    def restore_snapshot(self):
+        start = time.perf_counter()
+        with metrics.timed('snapshot.restore'):
+            if 'lights' in self.snapshot:
+                self.lights.refresh(self.snapshot['lights'])
+            if 'weather' in self.snapshot:
+                self.weather.apply(self.weather.restore(self.snapshot['weather']))
+        if self.snapshot:
+            print(f'[snapshot] restored in {(time.perf_counter() - start) * 1000:.0f}ms')
+
+    def save_snapshot(self):
+        weather = self.weather.dump()
+        if weather is not None:
+            self.snapshot['weather'] = weather
+        # copied, since the lights keep changing on this thread while the snapshot is written on another
+        self.snapshot['lights'] = [dict(light) for light in self.lights.get_lights()]
+        self.snapshot_task.start(dict(self.snapshot))
+
     def refresh_lights(self):
-        self.lights.refresh()
-        self.set_light_on_status()
+        if self.daemon is not None and self.daemon.connected:
+            # the daemon checks, and every dashboard following it hears about any changes
+            self.daemon.send({'refresh': 'lights'})
+            return
+        self.lights_task.start()
+
+    def on_lights_fetched(self, polled):
+        # None when nothing changed since the last poll
+        changed = polled is not None and self.lights.refresh(*polled)
+        if changed:
+            self.create_lights_ui()
+            self.save_snapshot()
+        self.light_poll_schedule.polled(changed)
+        self.schedule_light_poll()
+        self.woke_up_to_date('lights')
+
+    def following_lights(self):
+        # whether something's telling us about changes as they happen, so polling isn't needed
+        return any(feed is not None and feed.connected for feed in (self.light_stream, self.daemon))
+
+    def schedule_light_poll(self):
+        # nothing's polled while the screen's idle, waking up polls right away
+        if not self.following_lights() and not self.idle.idle:
+            self.light_poll_timer.start(int(self.light_poll_schedule.next_delay() * 1000))
+
+    def on_light_event(self, data):
+        # only the buttons for lights that actually changed are restyled
+        changed = self.lights.apply_event(data)
+        if isinstance(data, list):
+            # a full list of lights, which might have added or removed some
+            self.create_lights_ui()
+        for light_id in changed:
+            self.set_light_button(light_id, self.light_wanted.get(light_id, self.lights.get_light(light_id)['on']))
+        if changed:
+            self.save_snapshot()
+
+    def on_light_stream_status(self, connected):
+        if connected:
+            self.light_poll_timer.stop()
+            # anything could have changed while the stream was down
+            self.refresh_lights()
+        else:
+            self.schedule_light_poll()
+
+    def on_daemon_update(self, update):
+        section, value = update
+        if section == 'weather':
+            with metrics.timed('daemon.weather'):
+                state = self.weather.restore(value, stale=False)
+            if state is not None:
+                self.weather.apply(state)
+                self.update_weather_ui()
+                self.save_snapshot()
+                self.fetch_missing_icons()
+        elif section == 'lights' and self.lights.refresh(value):
+            self.create_lights_ui()
+            self.save_snapshot()
+
+    def on_daemon_status(self, connected):
+        # lights are polled from here while the daemon's gone, they're only on the local network. the weather
+        # isn't, every dashboard fetching it is what the daemon is there to avoid
+        if connected:
+            self.light_poll_timer.stop()
+        else:
+            self.schedule_light_poll()
+
+    def on_lights_failed(self, err):
+        self.lights.log('error reaching overseer')
+        self.lights.log(err)
+        self.light_poll_schedule.polled(False)
+        self.schedule_light_poll()
+        self.woke_up_to_date('lights')
 
     def update_time(self):
         now = datetime.now()
@@ -144,25 +544,79 @@ class Dashboard(QWidget):
         timer = QTimer(self)
         timer.timeout.connect(fn)
         timer.start(ms)
+        return timer
 
     def rebuild_weather(self):
-        self.weather.refresh()
+        if self.daemon is not None:
+            # the daemon sends the weather whenever it changes
+            return
+        # the fetch happens on a worker thread, if one is still running this just queues up a single re-run
+        self.weather_task.start()
+
+    def on_weather_fetched(self, state):
+        # None when nothing was due yet
+        if state is not None:
+            # always applied, since it has the new schedule even if nothing else changed
+            self.weather.apply(state)
+            if state.changed:
+                self.update_weather_ui()
+                self.save_snapshot()
+            self.fetch_missing_icons()
+        self.schedule_weather(max(1, self.weather.next_fetch_in()))
+        self.woke_up_to_date('weather')
+
+    def schedule_weather(self, delay):
+        # nothing's fetched while the screen's idle, waking up fetches whatever's due by then
+        if not self.idle.idle:
+            self.weather_timer.start(int(delay * 1000))
+
+    def fetch_missing_icons(self):
+        # a first start without a network can't download the icons, so they're tried again once the weather
+        # could be fetched, which means openweather can be reached now
+        if not icon_bundle.available and not self.icons_task.running:
+            self.icons_task.start()
+
+    def on_icons_fetched(self):
+        pixmap_cache.clear()
+        self.ui.invalidate('icon')
+        # dialogs filled in before there were icons are filled in again, even though their periods haven't changed
+        for details in self.forecast_details:
+            details.periods = None
         self.update_weather_ui()
 
+    def on_weather_failed(self, err):
+        print(f'[weather] error refreshing weather: {err}')
+        self.schedule_weather(retry_interval)
+        self.woke_up_to_date('weather')
+
     def create_lights_ui(self):
         layout = self.ui.by_id('lights-box')
 
         def create_light_button(l):
+            light_id = l['id']
+
             def on_click():
-                self.lights.toggle(l['id'])
-                self.set_light_on_status()
+                self.tap_light(light_id)
 
             button = QPushButton(l['name'])
-            self.light_buttons[l['id']] = button
+            self.light_buttons[light_id] = button
             button.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Expanding)
-
             button.clicked.connect(on_click)
             layout.addWidget(button)
+            if light_id in self.light_toggle_tasks:
+                # the layout was rebuilt, a toggle that's still going carries on with the new button
+                return
+
+            # taps in quick succession are settled into a single request once they stop for a moment
+            timer = QTimer(self)
+            timer.setSingleShot(True)
+            timer.timeout.connect(lambda: self.sync_light(light_id))
+            self.light_toggle_timers[light_id] = timer
+
+            task = BackgroundTask(self.lights.send_toggle, self)
+            task.finished.connect(lambda res: self.on_light_toggled(light_id, res))
+            task.failed.connect(lambda err: self.on_light_toggle_failed(light_id, err))
+            self.light_toggle_tasks[light_id] = task
 
         lights = self.lights.get_lights()
         if len(lights) is 0:
@@ -172,74 +626,196 @@ class Dashboard(QWidget):
             self.ui.hide('lights-error')
             self.ui.show('lights-container')
 
+        # this runs again whenever overseer's list of lights changes, so only lights we haven't seen get new
+        # buttons, and ones that have gone away are hidden
+        names = {light['id']: light['name'] for light in lights}
+        for light_id, button in self.light_buttons.items():
+            button.setVisible(light_id in names)
         for light in lights:
-            create_light_button(light)
+            button = self.light_buttons.get(light['id'])
+            if button is None:
+                create_light_button(light)
+            elif button.text() != light['name']:
+                button.setText(light['name'])
 
         self.set_light_on_status()
+        self.create_scenes_ui()
+
+    def create_scenes_ui(self):
+        scenes = list(self.lights.get_scenes())
+        if len(scenes) == 0 or len(self.lights.get_lights()) == 0:
+            self.ui.hide('scenes-container')
+            return
+
+        self.ui.show('scenes-container')
+        if scenes == self.scene_names:
+            return
+        # built again whenever the scenes in config.json change
+        for i in range(len(self.scene_names or [])):
+            self.ui.remove(f'scene-{i}')
+        self.scene_names = scenes
+        self.ui.add(self.ui.by_id('scenes-box'), scale_template(scene_button_template, len(scenes)))
+        for i, name in enumerate(scenes):
+            self.ui.set_text(f'scene-{i}', name)
+            self.ui.on_click(f'scene-{i}', lambda checked=False, name=name: self.apply_scene(name))
+
+    def apply_scene(self, name):
+        self.set_lights(self.lights.get_scenes()[name])
+
+    def set_lights(self, states):
+        # like tapping lights, the buttons change right away and the request happens in the background
+        states = {str(light_id): on for light_id, on in states.items()}
+        for light_id, on in states.items():
+            if self.lights.get_light(light_id) is not None:
+                self.light_wanted[light_id] = on
+                self.set_light_button(light_id, on)
+                self.scene_lights.add(light_id)
+        self.light_poll_schedule.interacted()
+        self.scene_task.start(states)
+
+    def on_lights_set(self, result):
+        self.lights.apply_set_many(result)
+        self.settle_scene_lights()
+        if self.daemon is not None:
+            self.refresh_lights()
+
+    def on_lights_set_failed(self, err):
+        self.lights.log(f'Error setting lights: {err}')
+        self.settle_scene_lights()
+
+    def settle_scene_lights(self):
+        if self.scene_task.running or self.scene_task.pending_args is not None:
+            # another scene was picked in the meantime, it'll settle everything when it's done
+            return
+        # anything overseer didn't change goes back to what it was, unless it's been tapped since
+        for light_id in self.scene_lights:
+            if not self.light_toggle_tasks[light_id].running and not self.light_toggle_timers[light_id].isActive():
+                self.light_wanted.pop(light_id, None)
+        self.scene_lights = set()
+        self.set_light_on_status()
 
     def set_light_on_status(self):
         for light in self.lights.get_lights():
-            button = self.light_buttons[light['id']]
-            button.setProperty('light-on', light['on'])
+            # lights that were just tapped keep showing what the user asked for until the toggle settles
+            self.set_light_button(light['id'], self.light_wanted.get(light['id'], light['on']))
+
+    def set_light_button(self, light_id, on):
+        button = self.light_buttons.get(light_id)
+        if button is not None and button.property('light-on') != on:
+            button.setProperty('light-on', on)
             self.update_widget(button)
 
+    def tap_light(self, light_id):
+        light = self.lights.get_light(light_id)
+        wanted = not self.light_wanted.get(light_id, light['on'])
+        self.light_wanted[light_id] = wanted
+        self.set_light_button(light_id, wanted)
+        self.light_toggle_timers[light_id].start(self.light_toggle_debounce)
+        # someone's here, keep up with changes they make elsewhere too
+        self.light_poll_schedule.interacted()
+        if self.light_poll_timer.remainingTime() > self.light_poll_schedule.fast * 1000:
+            self.schedule_light_poll()
+
+    def sync_light(self, light_id):
+        task = self.light_toggle_tasks[light_id]
+        # anything tapped while a toggle is in flight gets sorted out when it finishes
+        if task.running or light_id not in self.light_wanted:
+            return
+
+        if self.light_wanted[light_id] == self.lights.get_light(light_id)['on']:
+            # an even number of taps, nothing to do
+            del self.light_wanted[light_id]
+        else:
+            task.start(light_id)
+
+    def on_light_toggled(self, light_id, res):
+        if 'error' in res:
+            self.on_light_toggle_failed(light_id, res['error'])
+            return
+
+        if not self.lights.apply_toggle_response(light_id, res):
+            # older overseer versions don't tell us the new state, the toggle went through so assume it
+            # flipped, and check in the background in case something else changed it at the same time
+            self.lights.set_on(light_id, not self.lights.get_light(light_id)['on'])
+            self.refresh_lights()
+        elif self.daemon is not None:
+            # other dashboards only find out about it through the daemon
+            self.refresh_lights()
+
+        self.sync_light(light_id)
+        self.set_light_on_status()
+
+    def on_light_toggle_failed(self, light_id, err):
+        self.lights.log(f'Error toggling lights: {err}')
+        # roll back to whatever overseer last told us
+        self.light_wanted.pop(light_id, None)
+        self.set_light_on_status()
+
     def update_widget(self, widget):
         self.style().unpolish(widget)
         self.style().polish(widget)
 
     def update_weather_ui(self):
-        def set_temp(id, weather_data, temp_attr):
-            self.ui.set_text(id, weather_data[f'{temp_attr}-pretty'])
-            self.ui.set_stylesheet(id, get_temp_color_stylesheet(weather_data[temp_attr]))
-
-        self.ui.set_text('weather-box', f"Weather for {self.weather.get_location_name()}")
+        if not self.weather.has_weather():
+            # a first start, with no snapshot to show
+            self.ui.apply({'updated': 'waiting for the first weather update'})
+            return
+
+        # only widgets whose values changed get touched, all in one batch so a refresh never shows half old and half
+        # new data, and there's only one relayout
+        with metrics.timed('ui.weather_model'):
+            model = self.build_weather_model()
+        with metrics.timed('ui.apply'):
+            self.weather_widgets_touched = self.ui.apply(model)
+        widgets_touched_total.inc(self.weather_widgets_touched)
+        print(f'[ui] weather refresh touched {self.weather_widgets_touched} widgets')
+        QTimer.singleShot(0, self.prepare_forecast_details)
+
+    def build_weather_model(self):
+        # everything the weather widgets show, by the keys they're bound to in the layout
+        model = {}
+
+        def add_temps(prefix, weather_data, temp_types):
+            for temp_type in temp_types:
+                model[f'{prefix}.{temp_type}'] = getattr(weather_data, f'{temp_type}_pretty')
+                model[f'{prefix}.{temp_type}-bucket'] = get_temp_bucket(getattr(weather_data, temp_type))
+
+        model['location'] = f"Weather for {self.weather.get_location_name()}"
+        model['updated'] = f"last updated at {self.weather.get_updated_time()}"
+        if self.weather.is_stale():
+            model['updated'] += ' (from before the restart, updating...)'
 
         today = self.weather.get_todays_forecast()
-        self.ui.set_text('updated-time', f"last updated at {self.weather.get_updated_time()}")
-
-        set_temp('current-temperature', today, 'temp')
-        set_temp('today-low', today, 'low')
-        set_temp('today-high', today, 'high')
-        self.ui.set_text('current-conditions', f"{today['weather']}")
-        self.ui.set_icon('current-icon', today['weather-icon'])
-        self.connect_forecast_listener('today-details')
-
-        if 'alerts' in today:
-            self.ui.show('today-alert')
-            alerts = today['alerts']
-            self.ui.set_text('today-alert', f'{len(alerts)} active alert{"s" if len(alerts) > 1 else ""}')
-            self.connect_alert_listener('today-alert', alerts)
-        else:
-            self.ui.hide('today-alert')
-
-        def set_precip_message(label_id, message):
-            if message is not None:
-                self.ui.set_text(label_id, message)
-                self.ui.show(label_id)
-            else:
-                self.ui.hide(label_id)
-
-        rain_msg, snow_msg = self.weather.get_upcoming_precip_message()
-        set_precip_message('upcoming-rain', rain_msg)
-        set_precip_message('upcoming-snow', snow_msg)
-
-        # skip the current day
-        for i, day in enumerate(self.weather.get_days()[1:]):
-            self.ui.set_text(f'forecast-day-{i}', day['dt-pretty'])
-            self.ui.set_text(f'forecast-day-{i}-conditions', day['weather'])
-            self.connect_forecast_listener(f'forecast-day-{i}-details', day)
-            set_temp(f'forecast-day-{i}-low', day, 'low')
-            set_temp(f'forecast-day-{i}-high', day, 'high')
-            self.ui.set_icon(f'forecast-day-{i}-icon', day['weather-icon'], 50)
-
-            for precip in ['rain', 'snow']:
-                label_id = f'forecast-day-{i}-precip-{precip}'
-                set_precip_message(label_id, day[precip])
-
-    def connect_alert_listener(self, id, alerts):
+        add_temps('today', today, ['temp', 'low', 'high'])
+        model['today.weather'] = f"{today.weather}"
+        model['today.icon'] = today.weather_icon
+
+        alerts = self.weather.get_alerts()
+        model['today.alerts'] = f'{len(alerts)} active alert{"s" if len(alerts) > 1 else ""}' if alerts else None
+
+        model['upcoming-rain'], model['upcoming-snow'] = self.weather.get_upcoming_precip_message()
+
+        # skip the current day, and any days past what there's room to show
+        for i, day in enumerate(self.weather.get_days()[1:forecast_day_count + 1]):
+            add_temps(f'day.{i}', day, ['low', 'high'])
+            model[f'day.{i}.dt'] = day.dt_pretty
+            model[f'day.{i}.weather'] = day.weather
+            model[f'day.{i}.icon'] = day.weather_icon
+            model[f'day.{i}.rain'] = day.rain_pretty
+            model[f'day.{i}.snow'] = day.snow_pretty
+        return model
+
+    def connect_weather_listeners(self):
+        # handlers look up the current weather when they're clicked, so they only need connecting once per layout
+        self.connect_alert_listener('today-alert')
+        self.connect_forecast_listener('today-details', 0)
+        for i in range(forecast_day_count):
+            self.connect_forecast_listener(f'forecast-day-{i}-details', i + 1)
+
+    def connect_alert_listener(self, id):
         def show_weather_alert():
             layout = QVBoxLayout()
-            for alert in alerts:
+            for alert in self.weather.get_alerts():
                 header = QLabel(alert['headline'])
                 header.setWordWrap(True)
                 header.setProperty('header', True)
@@ -250,42 +826,82 @@ class Dashboard(QWidget):
 
         self.ui.on_click(id, show_weather_alert)
 
-    def connect_forecast_listener(self, id, day=None):
+    def connect_forecast_listener(self, id, day_index):
         def show_forecast():
-            periods = self.weather.get_periods_by_day(day)
+            details = self.get_forecast_details(day_index)
             # if it's late in the day for the current day, we might not have any more information, show an alert instead
-            if periods is None:
+            if details is None:
                 alert = Alert('No more data', "It is late and there is no more available data for today.")
                 return
-
-            layout = QHBoxLayout()
-            ui = UIBuilder(layout, scale_template(periods_detail_template, len(periods)))
-
-            for i, period in enumerate(periods):
-                ui.set_text(f'time-{i}', pretty_time_str_short(period['dt']))
-                ui.set_icon(f'icon-{i}', period['weather-icon'], 75)
-
-                temp_id = f'temp-{i}'
-                ui.set_text(temp_id, period['temp-pretty'])
-                ui.by_id(temp_id).setStyleSheet(get_temp_color_stylesheet(period['temp']))
-                ui.set_text(f'conditions-{i}', period['weather'])
-
-                def show_precip(precip_type):
-                    precip = period[precip_type]
-                    precip_id = f'{precip_type}-{i}'
-                    if precip is not None:
-                        ui.set_text(precip_id, precip)
-                    else:
-                        ui.hide(precip_id)
-
-                for precip_type in ['rain', 'snow']:
-                    show_precip(precip_type)
-
-            pretty_day = day["dt-pretty"] if day is not None else "Today"
-            dlg = ScrollMessageBox(f'Weather for {pretty_day}', layout)
+            details.box.exec()
 
         self.ui.on_click(id, show_forecast)
 
+    def prepare_forecast_details(self, day_index=0):
+        # fill in one day's dialog per trip through the event loop after a refresh, so they're ready before they're
+        # tapped without holding up the clock or touch input for all of them at once
+        if day_index < len(self.forecast_details):
+            self.get_forecast_details(day_index)
+            QTimer.singleShot(0, lambda: self.prepare_forecast_details(day_index + 1))
+
+    def get_forecast_details(self, day_index):
+        days = self.weather.get_days()
+        if day_index >= len(days) or days[day_index] is None:
+            return None
+
+        details = self.forecast_details[day_index]
+        day = days[day_index] if day_index > 0 else None
+        periods = self.weather.get_periods_by_day(day)
+        # refreshes that didn't fetch the forecast keep the same periods, so there's nothing to fill in again
+        if details.periods is not periods:
+            pretty_day = day.dt_pretty if day is not None else "Today"
+            with metrics.timed('ui.forecast_details'):
+                details.update(f'Weather for {pretty_day}', periods)
+        return details
+
+
+class ForecastDetails:
+    # a forecast dialog that's built once and refilled with each refresh's data, instead of a new one per tap
+    def __init__(self, slots=8):
+        self.layout = QHBoxLayout()
+        self.slots = slots
+        self.ui = UIBuilder(self.layout, scale_template(periods_detail_template, slots))
+        self.box = ScrollMessageBox('', self.layout, False)
+        self.periods = None  # what this was last filled in from
+
+    def update(self, title, periods):
+        ui = self.ui
+        if len(periods) > self.slots:
+            ui.add(self.layout, scale_template(periods_detail_template, len(periods), self.slots))
+            self.slots = len(periods)
+
+        for i in range(self.slots):
+            if i >= len(periods):
+                ui.hide(f'period-{i}')
+                continue
+
+            period = periods[i]
+            ui.show(f'period-{i}')
+            ui.set_text(f'time-{i}', pretty_time_str_short(period.dt))
+            ui.set_icon(f'icon-{i}', period.weather_icon, 75)
+
+            temp_id = f'temp-{i}'
+            ui.set_text(temp_id, period.temp_pretty)
+            ui.set_property(temp_id, 'temp-bucket', get_temp_bucket(period.temp))
+            ui.set_text(f'conditions-{i}', period.weather)
+
+            for precip_type in ['rain', 'snow']:
+                precip = getattr(period, f'{precip_type}_pretty')
+                precip_id = f'{precip_type}-{i}'
+                if precip is not None:
+                    ui.set_text(precip_id, precip)
+                    ui.show(precip_id)
+                else:
+                    ui.hide(precip_id)
+
+        self.box.setWindowTitle(title)
+        self.periods = periods
+
 
 class Alert(QMessageBox):
     def __init__(self, window_title, window_text):
@@ -298,7 +914,7 @@ class Alert(QMessageBox):
 
 
 class ScrollMessageBox(QMessageBox):
-    def __init__(self, window_title, child_layout):
+    def __init__(self, window_title, child_layout, show=True):
         QMessageBox.__init__(self)
         scroll = QScrollArea(self)
         scroll.setWidgetResizable(True)
@@ -313,10 +929,16 @@ class ScrollMessageBox(QMessageBox):
         self.setStyleSheet(default_styles)
         self.setWindowTitle(window_title)
         self.layout().addWidget(scroll, 0, 0, 1, 0)
-        self.exec()
+        if show:
+            self.exec()
 
 
 if __name__ == '__main__':
+    # for scraping with prometheus, and/or a rotated file for dashboards nothing can reach
+    if cfg.get('metrics-port', None):
+        metrics.serve(cfg.get('metrics-port'), cfg.get('metrics-host', '127.0.0.1'))
+    if cfg.get('metrics-file', None):
+        metrics.dump_to(cfg.get('metrics-file'), cfg.get('metrics-dump-interval', 60))
     app = QApplication([])
     dash = Dashboard()
     sys.exit(app.exec())
@@ -0,0 +1,185 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from logging.handlers import RotatingFileHandler
+
+# in seconds, from a quick dictionary lookup up to a request that's about to time out
+default_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+def format_labels(names, values, extra=''):
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_number(number):
+    return repr(float(number)) if number != float('inf') else '+Inf'
+
+
+class Counter:
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = {}  # label values -> count
+        registry.add(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{format_labels(self.label_names, key)} {format_number(value)}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = {}  # label values -> value
+        registry.add(self)
+
+    def set(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with registry.lock:
+            self.values[key] = value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        for key, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{format_labels(self.label_names, key)} {format_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, label_names=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = list(buckets) + [float('inf')]
+        self.values = {}  # label values -> [per bucket counts, sum, count]
+        registry.add(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with registry.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in sorted(self.values.items()):
+            # prometheus buckets count everything at or under their bound, not just what landed in them
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="' + format_number(bound) + '"'
+                lines.append(f'{self.name}_bucket{format_labels(self.label_names, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, key)} {format_number(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, key)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        # everything in prometheus' text format
+        with self.lock:
+            lines = [line for metric in self.metrics for line in metric.render()]
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+# name -> function returning something JSON can encode, all of them are served together at /status
+status_sources = {}
+
+phase_seconds = Histogram('dashboard_phase_seconds', 'How long each phase of refreshing or drawing took', ['phase'])
+phase_errors = Counter('dashboard_phase_errors_total', 'Phases that ended with an exception', ['phase'])
+
+
+def add_status(name, fn):
+    status_sources[name] = fn
+
+
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        phase_errors.inc(phase=phase)
+        raise
+    finally:
+        phase_seconds.observe(time.perf_counter() - start, phase=phase)
+
+
+def serve(port, host='127.0.0.1'):
+    # a /metrics endpoint for prometheus to scrape, and /status for anything else that wants to check in, on its
+    # own thread
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/status':
+                body = json.dumps({name: fn() for name, fn in status_sources.items()}, indent=4).encode('utf-8')
+                content_type = 'application/json'
+            elif path in ('/', '/metrics'):
+                body = registry.render().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    print(f'[metrics] serving on http://{host}:{port}/metrics and /status')
+    return server
+
+
+def dump_to(path, interval=60, max_bytes=1024 * 1024, backups=3):
+    # writes everything to a file every so often, for dashboards nothing can scrape. the file is rotated
+    # so it can't fill up an SD card
+    logger = logging.getLogger('dashboard-metrics')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups))
+
+    def dump():
+        while True:
+            time.sleep(interval)
+            logger.info(f'# dumped at {time.strftime("%Y-%m-%d %H:%M:%S")}\n{registry.render()}')
+
+    threading.Thread(target=dump, name='metrics-dump', daemon=True).start()
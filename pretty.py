@@ -27,6 +27,14 @@ def pretty_time_str_short(dt):
     return dt.strftime(f'%I %p')
 
 
+def pretty_length_of_time(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f'{hours}h{minutes:02}m'
+    return f'{minutes}m{seconds:02}s' if minutes else f'{seconds}s'
+
+
 def pretty_weekday(dt):
     return ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'][dt.weekday()]
 
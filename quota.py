@@ -0,0 +1,218 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+from files import atomic_write
+import metrics
+
+# what's been spent of each API's budget, so a restart (or a crash loop) doesn't start it over
+quota_path = 'cache/quota.json'
+quota_version = 1
+# how long to hold off after being told to slow down without being told for how long
+default_retry_after = 60
+# a call that needs to wait longer than this for the per-minute budget is refused instead, rather than holding
+# up a refresh
+max_wait = 10
+
+remaining_calls = metrics.Gauge('dashboard_quota_remaining_calls', 'API calls left in each budget this month',
+                                ['budget'])
+calls_total = metrics.Counter('dashboard_quota_calls_total', 'API calls by budget, and whether there was budget '
+                                                             'for them', ['budget', 'result'])
+
+
+class OverBudget(Exception):
+    def __init__(self, name, wait):
+        super().__init__(f'{name} is out of budget for the next {wait:.0f}s')
+        self.name = name
+        self.wait = wait
+
+
+def month_key(now):
+    return time.strftime('%Y-%m', time.localtime(now))
+
+
+def seconds_left_in_month(now):
+    today = datetime.fromtimestamp(now)
+    next_month = datetime(today.year + today.month // 12, today.month % 12 + 1, 1)
+    return next_month.timestamp() - now
+
+
+def parse_retry_after(value, now):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return default_retry_after
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - now)
+    except (TypeError, ValueError):
+        return default_retry_after
+
+
+# one API's budget. calls come out of a token bucket that refills at per_minute a minute, and out of a count
+# of calls made this calendar month. either limit can be None for no limit
+class Budget:
+    def __init__(self, quota, name, per_minute=None, per_month=None):
+        self.quota = quota
+        self.name = name
+        self.per_minute = per_minute
+        self.per_month = per_month
+        self.lock = threading.Lock()
+        now = time.time()
+        # wall clock times rather than monotonic ones, since they're saved across restarts
+        self.tokens = per_minute or 0
+        self.updated = now
+        self.month = month_key(now)
+        self.spent = 0
+        self.retry_at = 0
+
+    def log(self, msg):
+        print(f'[quota] {msg}')
+
+    def load(self, data, now):
+        if data.get('month') == month_key(now):
+            self.spent = data['spent']
+        if self.per_minute:
+            self.tokens = min(self.per_minute, data.get('tokens', self.per_minute))
+            self.updated = min(now, data.get('updated', now))
+        self.retry_at = data.get('retry-at', 0)
+        self.update_gauge()
+
+    def dump(self):
+        return {'month': self.month, 'spent': self.spent, 'tokens': self.tokens, 'updated': self.updated,
+                'retry-at': self.retry_at}
+
+    def refill(self, now):
+        if self.per_minute:
+            self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+        month = month_key(now)
+        if month != self.month:
+            self.month = month
+            self.spent = 0
+
+    def wait_time(self, now=None):
+        # seconds until the next call can be made
+        now = now or time.time()
+        with self.lock:
+            self.refill(now)
+            return self.wait_time_locked(now)
+
+    def wait_time_locked(self, now):
+        if self.per_month and self.spent >= self.per_month:
+            return seconds_left_in_month(now)
+        wait = self.retry_at - now
+        if self.per_minute and self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) * 60 / self.per_minute)
+        return max(0, wait)
+
+    def acquire(self, wait_up_to=max_wait):
+        # spends a call, waiting a little for the per-minute budget if it has to. raises OverBudget if there's
+        # no budget for it soon enough
+        while True:
+            now = time.time()
+            with self.lock:
+                self.refill(now)
+                wait = self.wait_time_locked(now)
+                if wait <= 0:
+                    self.tokens -= 1
+                    self.spent += 1
+                    break
+            if wait > wait_up_to:
+                calls_total.inc(budget=self.name, result='refused')
+                raise OverBudget(self.name, wait)
+            wait_up_to -= wait
+            time.sleep(wait)
+
+        calls_total.inc(budget=self.name, result='spent')
+        self.update_gauge()
+        if self.per_month and self.spent == int(self.per_month * 0.9):
+            self.log(f'{self.name} has used 90% of this month\'s {self.per_month} calls')
+        self.quota.save()
+
+    def back_off(self, retry_after):
+        # after the API said to slow down, nothing is sent until it said it's ok to again
+        now = time.time()
+        seconds = parse_retry_after(retry_after, now)
+        with self.lock:
+            self.retry_at = max(self.retry_at, now + seconds)
+        self.log(f'{self.name} asked us to slow down, waiting {seconds:.0f}s')
+        self.quota.save()
+
+    def stretch(self, calls_per_second):
+        # how many times longer than planned to wait between calls, so that making them at this rate doesn't use
+        # up the month's budget before the month's out
+        if not self.per_month:
+            return 1
+        now = time.time()
+        with self.lock:
+            self.refill(now)
+            left = max(1, self.per_month - self.spent)
+            return max(1, calls_per_second * seconds_left_in_month(now) / left)
+
+    def set_limits(self, per_minute, per_month):
+        # for when they're changed in config.json, what's been spent so far still counts
+        with self.lock:
+            self.refill(time.time())
+            self.per_minute = per_minute
+            self.per_month = per_month
+            if per_minute:
+                self.tokens = min(self.tokens, per_minute)
+        self.update_gauge()
+
+    def update_gauge(self):
+        if self.per_month:
+            remaining_calls.set(max(0, self.per_month - self.spent), budget=self.name)
+
+    def status(self):
+        now = time.time()
+        with self.lock:
+            self.refill(now)
+            return {
+                'per-minute': self.per_minute,
+                'available-this-minute': int(self.tokens) if self.per_minute else None,
+                'per-month': self.per_month,
+                'spent-this-month': self.spent,
+                'remaining-this-month': max(0, self.per_month - self.spent) if self.per_month else None,
+                'next-call-in': round(self.wait_time_locked(now), 1)
+            }
+
+
+class Quota:
+    def __init__(self, path=quota_path):
+        self.path = path
+        self.budgets = {}
+        self.lock = threading.Lock()
+        try:
+            with open(path) as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            saved = {}
+        self.saved = saved.get('budgets', {}) if saved.get('version') == quota_version else {}
+
+    def budget(self, name, per_minute=None, per_month=None):
+        budget = Budget(self, name, per_minute, per_month)
+        if name in self.saved:
+            budget.load(self.saved[name], time.time())
+        else:
+            budget.update_gauge()
+        self.budgets[name] = budget
+        return budget
+
+    def save(self):
+        # write then rename, so a power cut can't leave a half written file behind
+        with self.lock:
+            budgets = {name: budget.dump() for name, budget in self.budgets.items()}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            atomic_write(self.path, json.dumps({'version': quota_version, 'budgets': budgets}))
+
+    def status(self):
+        return {name: budget.status() for name, budget in self.budgets.items()}
+
+
+# shared by everything that calls a metered API
+quota = Quota()
+metrics.add_status('quota', quota.status)
@@ -0,0 +1,55 @@
+import os
+
+from PyQt5.QtCore import QObject, QFileSystemWatcher, QTimer, pyqtSignal
+
+
+def file_version(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+# notices when any of a few files are edited. QFileSystemWatcher uses inotify on linux, so nothing wakes up until a
+# file actually changes. where it can't watch a file this falls back to checking modification times every so often.
+# changed is emitted with the path as it was given, once a file has stopped changing for a moment, since editors
+# often save in a few steps
+class FileWatcher(QObject):
+    changed = pyqtSignal(str)
+
+    def __init__(self, paths, parent=None, settle=250, poll_interval=2):
+        super().__init__(parent)
+        self.paths = list(paths)
+        self.versions = {path: file_version(path) for path in self.paths}
+        self.settle_timer = QTimer(self)
+        self.settle_timer.setSingleShot(True)
+        self.settle_timer.setInterval(settle)
+        self.settle_timer.timeout.connect(self.check)
+        self.poll_timer = QTimer(self)
+        self.poll_timer.timeout.connect(self.check)
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.on_change)
+        # editors that save by renaming a new file over the old one take it out of the watch, the directories are
+        # watched too so those saves are noticed and the new file is watched instead
+        self.watcher.directoryChanged.connect(self.on_change)
+        directories = {os.path.dirname(os.path.abspath(path)) for path in self.paths}
+        unwatched = [path for path in self.paths + sorted(directories) if not self.watcher.addPath(path)]
+        if unwatched:
+            print(f'[reload] can\'t watch {", ".join(unwatched)} for changes, checking every {poll_interval}s instead')
+            self.poll_timer.start(poll_interval * 1000)
+
+    def on_change(self, path):
+        self.settle_timer.start()
+
+    def check(self):
+        watched = set(self.watcher.files())
+        for path in self.paths:
+            version = file_version(path)
+            if version is not None and path not in watched and not self.poll_timer.isActive():
+                self.watcher.addPath(path)
+            # a file that's gone for now is probably being saved, it's checked again when it's back
+            if version is not None and version != self.versions[path]:
+                self.versions[path] = version
+                self.changed.emit(path)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError
+
+import easy_requests
+from files import atomic_write
+from quota import OverBudget
+
+
+def get_expiry(headers, now, default_ttl):
+    cache_control = (headers.get('Cache-Control') or '').lower()
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return now
+
+    max_age = re.search(r'max-age=(\d+)', cache_control)
+    if max_age:
+        age = headers.get('Age')
+        return now + int(max_age.group(1)) - (int(age) if age and age.isdigit() else 0)
+
+    expires = headers.get('Expires')
+    if expires:
+        try:
+            return parsedate_to_datetime(expires).timestamp()
+        except (TypeError, ValueError):
+            # 'Expires: 0' and other junk means it's already expired
+            return now
+
+    return now + default_ttl
+
+
+# caches JSON API responses in memory and under cache/, so unchanged data doesn't need to be downloaded or
+# processed again. responses are reused without asking while they're fresh, and revalidated with
+# If-None-Match/If-Modified-Since once they aren't
+class ResponseCache:
+    def __init__(self, directory='cache/responses'):
+        self.directory = directory
+        self.entries = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, url, default_ttl=0, budget=None):
+        # returns the parsed response, and whether it's any different from what was cached before. requests that
+        # have to go over the network are taken out of the budget, when there isn't any left (or the API has
+        # said to slow down) the cached response is used for a little longer instead
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        entry = self.load(key)
+        now = time.time()
+
+        if entry is not None and entry['expires'] > now:
+            return entry['data'], False
+
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last-modified']:
+                headers['If-Modified-Since'] = entry['last-modified']
+
+        try:
+            if budget is not None:
+                budget.acquire()
+            res = easy_requests.client.request('GET', url, headers=headers)
+        except OverBudget:
+            if entry is None:
+                raise
+            return entry['data'], False
+        except HTTPError as err:
+            if budget is None or not (err.code == 429 or err.code == 503 and err.headers.get('Retry-After')):
+                raise
+            budget.back_off(err.headers.get('Retry-After'))
+            if entry is None:
+                raise
+            return entry['data'], False
+        expires = get_expiry(res.headers, now, default_ttl)
+
+        if res.status == 304 and entry is not None:
+            entry['expires'] = expires
+            self.save(key, entry)
+            return entry['data'], False
+
+        body = res.body.decode('utf-8')
+        changed = entry is None or entry['body'] != body
+        entry = {
+            'expires': expires,
+            'etag': res.headers.get('ETag'),
+            'last-modified': res.headers.get('Last-Modified'),
+            'body': body,
+            'data': json.loads(body)
+        }
+        self.save(key, entry)
+        return entry['data'], changed
+
+    def expire(self, url, expires):
+        # for when the caller knows better than the response's headers when it'll change. it's only written out
+        # again if it moved by more than a minute, that's close enough for after a restart
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        entry = self.load(key)
+        if entry is None:
+            return
+        moved = abs(entry['expires'] - expires)
+        with self.lock:
+            entry['expires'] = expires
+        if moved > 60:
+            self.save(key, entry)
+
+    def load(self, key):
+        with self.lock:
+            if key in self.entries:
+                return self.entries[key]
+
+        try:
+            with open(self.path(key)) as file:
+                entry = json.load(file)
+            entry['data'] = json.loads(entry['body'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+        with self.lock:
+            self.entries[key] = entry
+        return entry
+
+    def save(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+
+        atomic_write(self.path(key), json.dumps({k: v for k, v in entry.items() if k != 'data'}))
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
@@ -0,0 +1,25 @@
+import json
+
+from files import atomic_write
+import metrics
+
+# the last weather and lights the dashboard showed, so it has something to paint right away after a restart
+snapshot_path = 'cache/snapshot.json'
+snapshot_version = 1
+
+
+def load():
+    try:
+        with open(snapshot_path) as file:
+            snapshot = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if snapshot.get('version') != snapshot_version:
+        return None
+    return snapshot
+
+
+def save(snapshot):
+    with metrics.timed('snapshot.save'):
+        atomic_write(snapshot_path, json.dumps(dict(snapshot, version=snapshot_version), separators=(',', ':')))
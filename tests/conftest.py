@@ -0,0 +1,17 @@
+import json
+import sys
+
+import pytest
+
+sys.path.insert(0, __file__.rsplit('/tests/', 1)[0])
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    # the modules read config.json when they're imported, and keep their caches under the working directory
+    settings = {'zip-code': '12345', 'weather-api-key': 'key', 'overseer': 'overseer.test'}
+    (tmp_path / 'config.json').write_text(json.dumps(settings))
+    monkeypatch.chdir(tmp_path)
+    from config_reader import cfg
+    monkeypatch.setattr(cfg, 'config', settings)
+    return settings
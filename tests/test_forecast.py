@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+from forecast import Period, PrecipTimeline
+
+observed = datetime(2026, 10, 17, 13, 30)
+
+
+def period(dt, rain):
+    return Period(dt, 0, 50, 50, 50, 'rain' if rain else 'clear', 'Rain' if rain else 'Clear', 500 if rain else 800,
+                  '10d' if rain else '01d', rain, 0)
+
+
+def timeline(*rains):
+    # 3 hour periods, the first one started before the observation
+    start = observed - timedelta(hours=1, minutes=30)
+    return PrecipTimeline([period(start + timedelta(hours=3 * i), rain) for i, rain in enumerate(rains)], 'rain')
+
+
+def test_rain_that_already_started_keeps_going():
+    # it started raining before the observation and rains all afternoon
+    precip = timeline(0.1, 0.1, 0.1, 0)
+    assert precip.next_start(observed) == observed + timedelta(hours=1, minutes=30)
+    assert precip.next_stop(observed) == observed + timedelta(hours=7, minutes=30)
+
+
+def test_no_more_clear_periods():
+    # raining now, the period that's already started is clear, and nothing after it is
+    precip = timeline(0, 0.1, 0.1)
+    assert precip.next_stop(observed) is None
+    assert precip.next_start(observed) == observed + timedelta(hours=1, minutes=30)
+
+
+def test_message_when_rain_never_lets_up(config):
+    from weather import Weather
+
+    def entry(dt, rain, weather_id):
+        data = {'dt': int(dt.timestamp()), 'main': {'temp': 50, 'temp_min': 45, 'temp_max': 55},
+                'weather': [{'id': weather_id, 'main': 'Rain', 'description': 'rain', 'icon': '10d'}]}
+        if rain:
+            data['rain'] = {'3h': rain}
+        return data
+
+    now = datetime.now().replace(minute=0, second=0, microsecond=0)
+    current = dict(entry(now, 1, 500), coord={'lat': 0, 'lon': 0}, name='Testville')
+    forecast = {'list': [entry(now - timedelta(hours=1), 0, 800), entry(now + timedelta(hours=2), 1, 500),
+                         entry(now + timedelta(hours=5), 1, 500)]}
+    weather = Weather()
+    weather.apply(weather.build_state(current, forecast, []))
+    rain, snow = weather.get_upcoming_precip_message()
+    assert rain == 'The rain isn\'t expected to let up for the rest of the forecast.'
+    assert snow is None
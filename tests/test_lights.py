@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+
+class Response:
+    def __init__(self, lights):
+        self.status = 200
+        self.body = json.dumps(lights).encode('utf-8')
+        self.headers = {'ETag': '"1"'}
+
+    def json(self):
+        return json.loads(self.body)
+
+
+@pytest.fixture
+def lights(config):
+    from lights import Lights
+
+    lights = Lights()
+    lights.refresh([{'id': '1', 'name': 'Lamp', 'on': False}])
+    return lights
+
+
+def test_poll_that_started_before_a_tap_is_dropped(lights, monkeypatch):
+    import easy_requests
+
+    def request(method, url, headers=None):
+        # overseer answers with the light still off, and meanwhile it's tapped on
+        lights.set_on('1', True)
+        return Response([{'id': '1', 'name': 'Lamp', 'on': False}])
+
+    monkeypatch.setattr(easy_requests.client, 'request', request)
+    assert not lights.refresh(*lights.fetch())
+    assert lights.get_light('1')['on']
+    # and the next poll isn't skipped as unchanged
+    assert lights.etag is None and lights.digest is None
+
+
+def test_poll_after_a_tap_is_applied(lights, monkeypatch):
+    import easy_requests
+
+    lights.set_on('1', True)
+    monkeypatch.setattr(easy_requests.client, 'request',
+                        lambda method, url, headers=None: Response([{'id': '1', 'name': 'Lamp', 'on': False}]))
+    assert lights.refresh(*lights.fetch())
+    assert not lights.get_light('1')['on']
+
+
+def stream_delays(monkeypatch, events):
+    # how long the stream waits before each reconnect, when every connection ends cleanly after sending events
+    import lights
+
+    stream = lights.LightStream('http://overseer.test/lights/events', lambda data: None, lambda connected: None)
+    delays = []
+
+    def listen():
+        stream.events = events
+        return True
+
+    def sleep(delay):
+        delays.append(delay)
+        stream.stopped = len(delays) == 4
+
+    monkeypatch.setattr(stream, 'listen', listen)
+    monkeypatch.setattr(lights.time, 'sleep', sleep)
+    stream.run()
+    return delays
+
+
+def test_stream_that_closes_straight_away_backs_off(config, monkeypatch):
+    assert stream_delays(monkeypatch, events=0) == [1, 2, 4, 8]
+
+
+def test_stream_that_was_up_reconnects_quickly(config, monkeypatch):
+    assert stream_delays(monkeypatch, events=3) == [1, 1, 1, 1]
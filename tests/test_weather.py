@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+now = datetime.now().replace(minute=0, second=0, microsecond=0)
+
+
+def entry(dt, weather_id=800):
+    return {'dt': int(dt.timestamp()), 'main': {'temp': 50, 'temp_min': 45, 'temp_max': 55},
+            'weather': [{'id': weather_id, 'main': 'Clear', 'description': 'clear sky', 'icon': '01d'}]}
+
+
+current = dict(entry(now), coord={'lat': 0, 'lon': 0}, name='Testville')
+forecast = {'list': [entry(now + timedelta(hours=3 * i)) for i in range(16)]}
+
+
+@pytest.fixture
+def weather(config, monkeypatch):
+    from weather import Weather
+
+    weather = Weather()
+    # neither response has changed since the snapshot was saved
+    responses = {'weather': current, 'forecast': forecast}
+    monkeypatch.setattr(weather, 'make_api_call', lambda api, ttl: (responses[api.split('?')[0]], False))
+    weather.apply(weather.build_state(current, forecast, []))
+    weather.apply(weather.restore(weather.dump()))
+    return weather
+
+
+def test_snapshot_caught_up_on_over_separate_fetches(weather):
+    assert weather.is_stale()
+    weather.refresh(['current'])
+    assert weather.is_stale()
+    weather.refresh(['forecast'])
+    assert not weather.is_stale()
+    assert weather.state.changed == {'forecast'}
+
+
+def test_failed_fetch_doesnt_count(weather):
+    weather.refresh(['current'])
+
+    def fail(api, ttl):
+        raise OSError('no network')
+
+    weather.make_api_call = fail
+    weather.refresh(['forecast'])
+    assert weather.is_stale()
+
+
+def test_days_move_on_after_midnight(weather, monkeypatch):
+    import weather as weather_module
+
+    class Tomorrow(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.now(tz) + timedelta(days=1)
+
+    monkeypatch.setattr(weather_module, 'datetime', Tomorrow)
+    weather.refresh(['current'])
+    tomorrow = (now + timedelta(days=1)).date()
+    assert 'forecast' in weather.state.changed
+    assert weather.get_days()[0].dt == tomorrow
+    assert all(period.dt.date() == tomorrow for period in weather.get_periods_by_day())
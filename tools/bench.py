@@ -0,0 +1,247 @@
+# times the dashboard's hot paths against recorded responses under Qt's offscreen platform, and compares them with
+# earlier runs on the same machine so slowdowns get caught. exits with 1 if anything got slower than --threshold
+#   python -m tools.bench [--runs 15] [--latency 0.05] [--threshold 0.25] [--no-save]
+#   python -m tools.bench --record     records new fixtures using config.json, this needs the real APIs
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# anything slower than its baseline by less than this is noise, however big a fraction of the baseline it is
+noise_floor_ms = 0.2
+# how many earlier runs the baseline is the median of
+baseline_runs = 5
+
+
+def record(fixtures):
+    # run in the repo with the real config.json, everything fetched is written to the fixtures directory
+    import easy_requests
+    from config_reader import cfg
+    from icons import icon_bundle, icon_names
+    from lights import Lights
+    from response_cache import ResponseCache
+    from weather import Weather
+
+    easy_requests.client.record(fixtures)
+    with tempfile.TemporaryDirectory() as responses:
+        weather = Weather()
+        weather.responses = ResponseCache(responses)
+        weather.refresh()
+    Lights().fetch()
+    for icon_name in icon_names:
+        icon_bundle.download(icon_name)
+
+    # the benchmarks run with this instead of a real config.json, the fixtures only match this zip code and overseer
+    with open(os.path.join(fixtures, 'config.json'), 'w') as file:
+        json.dump({'weather-api-key': 'redacted', 'zip-code': cfg.get('zip-code'), 'overseer': cfg.get('overseer'),
+                   'light-stream': False}, file, indent=4)
+    print(f'recorded {len(os.listdir(fixtures)) - 1} responses to {fixtures}')
+
+
+def prepare(repo, fixtures, workdir, latency):
+    # everything runs in a scratch directory, so nothing in the repo's cache/ is used or touched
+    from tools.replay_server import freshen_directory, load_fixtures, rewrites, ReplayServer
+
+    shutil.copy(os.path.join(fixtures, 'config.json'), os.path.join(workdir, 'config.json'))
+    for name in ['ui.txt', 'styles.css']:
+        shutil.copy(os.path.join(repo, name), os.path.join(workdir, name))
+    freshen_directory(fixtures, os.path.join(workdir, 'fixtures'))
+    os.chdir(workdir)
+    os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+
+    import easy_requests
+    if latency is None:
+        easy_requests.client.replay('fixtures')
+        return
+
+    # over real sockets, through the replay server
+    replay = ReplayServer(load_fixtures('fixtures'), latency)
+    server = replay.serve(0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for prefix, replacement in rewrites(replay.fixtures, f'http://127.0.0.1:{server.server_address[1]}'):
+        easy_requests.client.rewrite(prefix, replacement)
+
+
+def measure(fn, runs, setup=None):
+    # median time of fn in ms, anything setup returns is passed to it and isn't timed
+    times = []
+    for _ in range(runs):
+        arg = setup() if setup else None
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            if setup:
+                fn(arg)
+            else:
+                fn()
+            times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def run_benchmarks(runs):
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication([])
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+        import uibuilder
+        from icons import icon_bundle
+        from response_cache import ResponseCache
+        from weather import Weather, sources
+        icon_bundle.prefetch()
+
+    results = {}
+
+    def fresh_weather():
+        weather = Weather()
+        weather.responses = ResponseCache(tempfile.mkdtemp(dir='cache'))
+        return weather
+
+    results['weather.refresh.cold'] = measure(lambda weather: weather.refresh(), runs, fresh_weather)
+    with contextlib.redirect_stdout(io.StringIO()):
+        warm = fresh_weather()
+        warm.refresh()
+    # every source, rather than only the ones that are due, which right after a refresh is none of them
+    results['weather.refresh.unchanged'] = measure(lambda: warm.refresh(sources), runs)
+
+    with open('ui.txt') as file:
+        raw_ui = file.read() + main.scale_template(main.forecast_day_template, main.forecast_day_count)
+    results['ui.parse'] = measure(lambda: uibuilder.parse_tree(raw_ui), runs)
+
+    def forget_layouts():
+        uibuilder.compiled_layouts.clear()
+    results['ui.parse.cached'] = measure(lambda _: uibuilder.compile_layout(raw_ui), runs, forget_layouts)
+
+    def settle():
+        # let the refreshes each dashboard starts finish, so they aren't running during the next benchmark
+        for _ in range(25):
+            app.processEvents()
+            time.sleep(0.02)
+
+    # kept around rather than deleted, their background refreshes still report back to them
+    dashboards = []
+
+    def startup(_):
+        dashboards.append(main.Dashboard())
+        app.processEvents()
+
+    def stop_watching_input():
+        # each dashboard filters every event in the app while it's watching for input, there's only ever one
+        # dashboard doing that for real
+        for dashboard in dashboards:
+            dashboard.idle.stop()
+    results['dashboard.startup'] = measure(startup, runs, stop_watching_input)
+    stop_watching_input()
+    for dash in dashboards:
+        dash.close()
+    settle()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        dash = main.Dashboard()
+        settle()
+        dash.weather.apply(warm.state)
+
+    def invalidate():
+        dash.ui.invalidate()
+    results['ui.update_weather'] = measure(lambda _: dash.update_weather_ui(), runs, invalidate)
+    results['ui.update_weather.unchanged'] = measure(dash.update_weather_ui, runs)
+
+    day = warm.get_days()[1]
+    periods = warm.get_periods_by_day(day)
+    results['ui.forecast_dialog'] = measure(
+        lambda: main.ForecastDetails().update('Weather', periods), runs)
+    details = main.ForecastDetails()
+    results['ui.forecast_dialog.refill'] = measure(lambda: details.update('Weather', periods), runs)
+
+    # the app is destroyed as this returns, before the dashboard is
+    dash.idle.stop()
+    return results
+
+
+def git_commit(repo):
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=repo, capture_output=True, text=True).stdout.strip()
+
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    return commit + ('-dirty' if git('status', '--porcelain', '--untracked-files=no') else '')
+
+
+def load_history(path):
+    try:
+        with open(path) as file:
+            return [json.loads(line) for line in file if line.strip()]
+    except OSError:
+        return []
+
+
+def compare(results, history, commit, latency, threshold):
+    # each benchmark against the median of the last few runs on this machine from other commits
+    earlier = [run for run in history if run['host'] == platform.node() and run['commit'] != commit and
+               run.get('latency') == latency][-baseline_runs:]
+    regressions = []
+    print(f'{"benchmark":<30} {"ms":>10} {"baseline":>10} {"change":>8}')
+    for name, ms in results.items():
+        baseline = [run['results'][name] for run in earlier if name in run['results']]
+        if not baseline:
+            print(f'{name:<30} {ms:>10.3f} {"-":>10} {"-":>8}')
+            continue
+
+        baseline_ms = statistics.median(baseline)
+        change = (ms - baseline_ms) / baseline_ms if baseline_ms else 0
+        regressed = change > threshold and ms - baseline_ms > noise_floor_ms
+        if regressed:
+            regressions.append(name)
+        print(f'{name:<30} {ms:>10.3f} {baseline_ms:>10.3f} {change:>+8.0%}{"  <- slower" if regressed else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='dashboard benchmarks against recorded responses')
+    parser.add_argument('--fixtures', default='tools/fixtures')
+    parser.add_argument('--runs', type=int, default=15)
+    parser.add_argument('--latency', type=float, default=None,
+                        help='serve the fixtures over HTTP with this many seconds of latency, instead of in process')
+    parser.add_argument('--threshold', type=float, default=0.25, help='how much slower counts as a regression')
+    parser.add_argument('--history', default='cache/bench-history.jsonl')
+    parser.add_argument('--no-save', action='store_true', help='don\'t add this run to the history')
+    parser.add_argument('--record', action='store_true', help='record new fixtures from the real APIs')
+    args = parser.parse_args()
+
+    repo = os.getcwd()
+    fixtures = os.path.abspath(args.fixtures)
+    history_path = os.path.abspath(args.history)
+    if args.record:
+        record(fixtures)
+        return
+
+    commit = git_commit(repo)
+    with tempfile.TemporaryDirectory(prefix='dashboard-bench-') as workdir:
+        prepare(repo, fixtures, workdir, args.latency)
+        results = run_benchmarks(args.runs)
+        os.chdir(repo)
+
+    regressions = compare(results, load_history(history_path), commit, args.latency, args.threshold)
+    if regressions and not args.no_save:
+        print('not saving this run, so it doesn\'t become part of the baseline')
+    elif not args.no_save:
+        os.makedirs(os.path.dirname(history_path), exist_ok=True)
+        with open(history_path, 'a') as file:
+            file.write(json.dumps({'commit': commit, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                   'host': platform.node(), 'python': platform.python_version(),
+                                   'latency': args.latency, 'results': results}) + '\n')
+
+    if regressions:
+        print(f'{len(regressions)} benchmark{"s" if len(regressions) > 1 else ""} got slower: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
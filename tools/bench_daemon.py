@@ -0,0 +1,123 @@
+# times a daemon serving many dashboards: how long it takes them all to connect, how long each change takes to
+# reach every one of them, and how many bytes a change costs compared to sending the whole state. the clients are
+# threads in this process, so their JSON parsing competes with the daemon's for the GIL and the numbers are on the
+# pessimistic side of a building full of separate dashboards
+#   python -m tools.bench_daemon [--clients 50] [--updates 200] [--unix]
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+from daemon import DaemonClient, StateHub, encode, make_server
+from tools.bench_forecast import make_payload
+from weather import Weather
+
+
+def make_weather():
+    weather = Weather()
+    weather.apply(weather.build_state(*make_payload(40), []))
+    return weather.dump()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='daemon fan-out to many dashboards')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--updates', type=int, default=200)
+    parser.add_argument('--lights', type=int, default=20)
+    parser.add_argument('--weather-every', type=int, default=10, help='every nth update is a new forecast')
+    parser.add_argument('--unix', action='store_true', help='use a Unix socket instead of TCP')
+    args = parser.parse_args()
+
+    random.seed(1)
+    hub = StateHub()
+    lights = [{'id': str(i), 'name': f'Light {i}', 'on': False} for i in range(args.lights)]
+    hub.publish('lights', lights)
+    hub.publish('weather', make_weather())
+
+    workdir = tempfile.mkdtemp(prefix='dashboard-daemon-bench-')
+    address = f'unix:{os.path.join(workdir, "daemon.sock")}' if args.unix else '127.0.0.1:0'
+    server = make_server(address, hub, lambda command: None)
+    if not args.unix:
+        address = f'127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # every client counts what it's received, the benchmark waits until they've all got each change
+    received = threading.Semaphore(0)
+    connected = threading.Semaphore(0)
+    arrivals = []
+    arrivals_lock = threading.Lock()
+
+    def on_update(update):
+        with arrivals_lock:
+            arrivals.append(time.perf_counter())
+        received.release()
+
+    def on_status(is_connected):
+        if is_connected:
+            connected.release()
+
+    start = time.perf_counter()
+    clients = [DaemonClient(address, on_update, on_status) for _ in range(args.clients)]
+    for client in clients:
+        client.log = lambda msg: None
+        client.start()
+    for _ in clients:
+        connected.acquire()
+    # each client is handed the weather and the lights when it connects
+    for _ in range(len(clients) * 2):
+        received.acquire()
+    connect_ms = (time.perf_counter() - start) * 1000
+    full_bytes = len(encode({'seq': hub.seq, 'state': hub.state}))
+
+    # built ahead of time, so only sending them is counted
+    forecasts = [make_weather() for _ in range(args.updates // args.weather_every)]
+    latencies = {'lights': [], 'weather': []}
+    sizes = {'lights': [], 'weather': []}
+    cpu_start = time.process_time()
+    for i in range(args.updates):
+        if (i + 1) % args.weather_every == 0:
+            section, value = 'weather', forecasts.pop()
+        else:
+            light = random.choice(lights)
+            light['on'] = not light['on']
+            section, value = 'lights', lights
+
+        with arrivals_lock:
+            arrivals.clear()
+        start = time.perf_counter()
+        sizes[section].append(hub.publish(section, value))
+        for _ in clients:
+            received.acquire()
+        with arrivals_lock:
+            latencies[section].append([(arrival - start) * 1000 for arrival in arrivals])
+    cpu_ms = (time.process_time() - cpu_start) * 1000
+
+    for client in clients:
+        client.stop()
+    server.shutdown()
+
+    print(f'{args.clients} dashboards over {"a Unix socket" if args.unix else "TCP"}, connected in {connect_ms:.0f}ms, '
+          f'whole state {full_bytes} bytes')
+    print(f'{"change":>8} {"count":>6} {"bytes":>7} {"first ms":>9} {"median ms":>10} {"p95 ms":>8} {"all ms":>8}')
+    for section in ['lights', 'weather']:
+        if not latencies[section]:
+            continue
+        firsts = [min(times) for times in latencies[section]]
+        everyone = [max(times) for times in latencies[section]]
+        each = [ms for times in latencies[section] for ms in times]
+        print(f'{section:>8} {len(latencies[section]):>6} {statistics.median(sizes[section]):>7.0f} '
+              f'{statistics.median(firsts):>9.3f} {statistics.median(each):>10.3f} {percentile(each, 0.95):>8.3f} '
+              f'{statistics.median(everyone):>8.3f}')
+    print(f'{cpu_ms / args.updates:.2f}ms of CPU per change, for the daemon and every client together')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# compares building the forecast as nested dicts against the typed Period/Day model, for time to build a refresh,
+# time to show one, and how much memory each keeps alive
+#   python -m tools.bench_forecast [--periods 40]
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from copy import copy
+from datetime import datetime
+
+from pretty import pretty_temp, pretty_weekday, pretty_date_str, pretty_length
+from weather import Weather
+
+mains = [('Clear', 800, '01d'), ('Clouds', 803, '04d'), ('Rain', 500, '10d'), ('Snow', 600, '13d')]
+
+
+def make_payload(periods):
+    # openweather's forecast response, one period every three hours starting now
+    start = int(time.time()) // 10800 * 10800
+    items = []
+    for i in range(periods):
+        main, weather_id, icon = random.choice(mains)
+        item = {
+            'dt': start + i * 10800,
+            'main': {'temp': random.uniform(-10, 100)},
+            'weather': [{'description': main.lower(), 'main': main, 'id': weather_id, 'icon': icon}]
+        }
+        if main in ('Rain', 'Snow'):
+            item[main.lower()] = {'3h': random.uniform(0, 10)}
+        items.append(item)
+    today = dict(items[0], coord={'lat': 0, 'lon': 0}, name='Benchmark')
+    return today, {'list': items}
+
+
+def legacy_collect(forecast):
+    temps = forecast['main']
+    weather = forecast['weather'][0]
+    dt = datetime.fromtimestamp(forecast['dt'])
+    now = datetime.now()
+    today = datetime(now.year, now.month, now.day)
+
+    def get_precip_amount(precip_type):
+        precip = forecast.get(precip_type, {})
+        return precip.get('3h', precip.get('1h', 0))
+
+    return {
+        "dt": dt,
+        "days-from-now": (dt - today).days,
+        "dt-pretty": pretty_date_str(dt),
+        "temp": temps['temp'],
+        "low": temps['temp'],
+        "high": temps['temp'],
+        "weather": weather["description"],
+        "weather-main": weather["main"],
+        "weather-id": weather["id"],
+        "weather-icon": weather["icon"],
+        "rain": 0.0393701 * get_precip_amount('rain'),
+        "snow": 0.0393701 * get_precip_amount('snow')
+    }
+
+
+def legacy_build(today_forecast, forecast5):
+    # how Weather.fetch built everything before, every string formatted up front and each period copied for its day
+    forecast_today = legacy_collect(today_forecast)
+    periods = [legacy_collect(period) for period in forecast5['list']]
+
+    def make_pretty(data):
+        data['rain'] = f"{pretty_length(data['rain'])} rain" if data['rain'] else None
+        data['snow'] = f"{pretty_length(data['snow'])} snow" if data['snow'] else None
+        for temp_type in ['temp', 'low', 'high']:
+            if temp_type in data:
+                data[temp_type + '-pretty'] = pretty_temp(data[temp_type])
+        return data
+
+    days = [None] * (1 + max(x['days-from-now'] for x in periods))
+    periods_by_day = copy(days)
+    for period in periods:
+        delta = period['days-from-now']
+        if not days[delta]:
+            dt = period['dt'].date()
+            days[delta] = {"dt": dt, "dt-pretty": pretty_weekday(dt), "rain": 0, "snow": 0, "low": period['low'],
+                           "high": period['high'], "weather-mains": []}
+            periods_by_day[delta] = []
+        this_day = days[delta]
+        this_day['low'] = min(this_day['low'], period['low'])
+        this_day['high'] = max(this_day['high'], period['high'])
+        this_day['rain'] += period['rain']
+        this_day['snow'] += period['snow']
+        this_day['weather-mains'].append(period['weather-main'])
+        periods_by_day[delta].append(make_pretty(copy(period)))
+
+    for day in days:
+        if day is not None:
+            make_pretty(day)
+            mains_ = day['weather-mains']
+            day['weather'] = max(set(mains_), key=mains_.count)
+
+    fc = forecast_today
+    fc['low'] = min(fc['low'], days[0]['low'])
+    fc['high'] = max(fc['high'], days[0]['high'])
+    return make_pretty(fc), periods, days, periods_by_day
+
+
+def legacy_show(built):
+    # everything the dashboard and every forecast dialog read after a refresh
+    today, periods, days, periods_by_day = built
+    shown = [today['temp-pretty'], today['low-pretty'], today['high-pretty'], today['dt-pretty']]
+    for day in days[1:]:
+        shown += [day['dt-pretty'], day['low-pretty'], day['high-pretty'], day['rain'], day['snow']]
+    for day_periods in periods_by_day:
+        for period in day_periods or []:
+            shown += [period['temp-pretty'], period['rain'], period['snow']]
+    return shown
+
+
+def typed_build(weather, today_forecast, forecast5):
+    return weather.build_state(today_forecast, forecast5, [])
+
+
+def typed_show(state):
+    today = state.forecast_today
+    shown = [today.temp_pretty, today.low_pretty, today.high_pretty, today.dt_pretty]
+    for day in state.days[1:]:
+        shown += [day.dt_pretty, day.low_pretty, day.high_pretty, day.rain_pretty, day.snow_pretty]
+    for day in state.days:
+        for period in day.periods if day else []:
+            shown += [period.temp_pretty, period.rain_pretty, period.snow_pretty]
+    return shown
+
+
+def best_of(fn, runs=20):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def kept_bytes(fn):
+    tracemalloc.start()
+    result = fn()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='dict vs typed forecast model')
+    parser.add_argument('--periods', type=int, default=40, help='periods in the forecast, openweather sends 40')
+    args = parser.parse_args()
+
+    random.seed(1)
+    today_forecast, forecast5 = make_payload(args.periods)
+    weather = Weather()
+
+    if legacy_show(legacy_build(today_forecast, forecast5)) != typed_show(
+            typed_build(weather, today_forecast, forecast5)):
+        print('the typed model shows something different from the old dicts!')
+        sys.exit(1)
+
+    print(f'{"":>8} {"build ms":>10} {"show ms":>10} {"kept KiB":>10}')
+    for name, build, show in [('dicts', lambda: legacy_build(today_forecast, forecast5), legacy_show),
+                              ('typed', lambda: typed_build(weather, today_forecast, forecast5), typed_show)]:
+        build_ms = best_of(build)
+        show_ms = best_of(lambda: show(build())) - build_ms
+        print(f'{name:>8} {build_ms:>10.3f} {show_ms:>10.3f} {kept_bytes(build) / 1024:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
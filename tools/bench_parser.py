@@ -0,0 +1,125 @@
+# compares the old recursive UIBuilder parser against the single pass one, on layouts of 10^2 - 10^4 lines
+#   python -m tools.bench_parser
+import re
+import sys
+import time
+
+import uibuilder
+
+block = """QGroupBox#group-{i}(detail-group=true) Group
+    QVBoxLayout
+        QHBoxLayout
+            QLabel#time-{i}.time(align=right)
+            QLabel#temp-{i}.temperature
+        //a comment that should be skipped
+        QLabel#icon-{i}
+        QPushButton#button-{i}(expanding=true,style=height:150px;) Press
+        stretch
+"""
+
+
+def legacy_parse_line(line):
+    # the parser as it was, recompiling every regex for every line
+    def next_match(reg, text):
+        match = re.search(reg, text)
+        if match:
+            m = match.group(1)
+            return m, text[len(match.group(0)):]
+        return None, text
+
+    spaces = re.match(r'\s*', line)
+    indent = len(spaces[0]) / 4 if spaces else 0
+    line = line.strip()
+    name, line = next_match(r'(\w+)', line)
+    id, line = next_match(r'#([\w\-_\d]+)\b', line)
+    class_name, line = next_match(r'\.([\w\-_\d]*)', line)
+
+    attrs = {}
+    attr_match, line = next_match(r'\((.*)\)', line)
+    if attr_match:
+        for attr in re.split(r'\s*,\s*', attr_match):
+            key, val = attr.split('=')
+            attrs[key] = val
+
+    text, line = next_match(r' ([\w -]*)', line)
+    return indent, name, id, class_name, attrs, text
+
+
+def legacy_parse(raw):
+    # same walk the old UIBuilder.parse did, slicing the remaining lines at every level, but building the
+    # same tree parse_tree does instead of widgets so the two can be compared
+    lines = [line for line in raw.split('\n') if not re.match(r'(\s*//)|(\s*$)', line)]
+
+    def parse(parent, level, lines):
+        last_line = None
+        skipping_children = False
+        for index, line in enumerate(lines):
+            indent, widget_name, id, class_name, attrs, text = legacy_parse_line(line)
+            if indent < level:
+                return
+            elif indent > level:
+                if not skipping_children:
+                    skipping_children = True
+                    parse(last_line[5], indent, lines[index:])
+                continue
+            elif skipping_children and level == indent:
+                skipping_children = False
+
+            last_line = [widget_name, id, class_name, attrs, text, []]
+            parent.append(last_line)
+
+    roots = []
+    parse(roots, 0, lines)
+    return roots
+
+
+def make_layout(lines):
+    raw = ''
+    i = 0
+    while raw.count('\n') < lines:
+        raw += block.replace('{i}', str(i))
+        i += 1
+    return raw
+
+
+def without_dotted_values(raw):
+    # the old parser takes the first '.' anywhere after the id as the start of a class name, even inside an
+    # attribute value like bind=today.icon. that's a bug it always had, so those values are left out of the comparison
+    return re.sub(r'\(.*\)', lambda attrs: attrs.group(0).replace('.', '-'), raw)
+
+
+def best_of(fn, runs=5):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main():
+    with open('ui.txt') as file:
+        real_ui = without_dotted_values(file.read())
+    if legacy_parse(real_ui) != uibuilder.parse_tree(real_ui):
+        print('parse_tree disagrees with the old parser on ui.txt!')
+        sys.exit(1)
+
+    print(f'{"lines":>8} {"old ms":>10} {"new ms":>10} {"cached ms":>10}')
+    for lines in [100, 1000, 10000]:
+        raw = make_layout(lines)
+        if legacy_parse(raw) != uibuilder.parse_tree(raw):
+            print(f'parse_tree disagrees with the old parser on {lines} lines!')
+            sys.exit(1)
+
+        old = best_of(lambda: legacy_parse(raw))
+        new = best_of(lambda: uibuilder.parse_tree(raw))
+        uibuilder.compiled_layouts.clear()
+        uibuilder.compile_layout(raw)  # make sure it's on disk
+        uibuilder.compiled_layouts.clear()
+        cached = best_of(lambda: uibuilder.compile_layout(raw), 1)
+        print(f'{lines:>8} {old:>10.2f} {new:>10.2f} {cached:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
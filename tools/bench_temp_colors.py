@@ -0,0 +1,120 @@
+# compares colouring temperature labels with per-widget stylesheets against the temp-bucket property
+#   python -m tools.bench_temp_colors
+import os
+import re
+import sys
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtWidgets import QApplication, QLabel, QVBoxLayout, QWidget
+
+# needs a config.json like the dashboard itself does
+from main import get_temp_bucket, default_styles
+
+
+def legacy_temperature_color(degrees):
+    # how colours were picked before, one branch at a time
+    if degrees > 100:
+        return 'cc006c'
+    elif degrees > 90:
+        return 'fe3300'
+    elif degrees > 80:
+        return 'fe6601'
+    elif degrees > 70:
+        return 'fe8a33'
+    elif degrees > 60:
+        return 'ffbf00'
+    elif degrees > 50:
+        return 'fdff00'
+    elif degrees > 40:
+        return '3fff6e'
+    elif degrees > 30:
+        return '34cbc6'
+    elif degrees > 20:
+        return '35cbcb'
+    elif degrees > 10:
+        return '009afe'
+    elif degrees > 0:
+        return '2f34c9'
+    elif degrees > -10:
+        return '6a00ce'
+    elif degrees > -20:
+        return '9901f6'
+    elif degrees > -30:
+        return 'cd98fe'
+    else:
+        return 'e3e1ed'
+
+
+def restyle(label):
+    label.style().unpolish(label)
+    label.style().polish(label)
+
+
+def time_it(fn, labels, temps):
+    start = time.perf_counter()
+    for temp in temps:
+        for label in labels:
+            fn(label, temp)
+    return (time.perf_counter() - start) * 1000
+
+
+def with_stylesheet(label, temp):
+    label.setStyleSheet(f'color: #{legacy_temperature_color(temp)};')
+    restyle(label)
+
+
+def with_property(label, temp):
+    label.setProperty('temp-bucket', get_temp_bucket(temp))
+    restyle(label)
+
+
+def main():
+    bucket_colors = {bucket: color for bucket, color in
+                     re.findall(r'QLabel\[temp-bucket="(\d+)"\] \{\s*color: #(\w+);', default_styles)}
+    for tenths in range(-500, 1200):
+        temp = tenths / 10
+        if bucket_colors[get_temp_bucket(temp)] != legacy_temperature_color(temp):
+            print(f'styles.css disagrees with the old colours at {temp}°!')
+            sys.exit(1)
+
+    app = QApplication([])
+    top = QWidget()
+    top.setObjectName('top-level')
+    layout = QVBoxLayout(top)
+    # the same number of temperature labels the dashboard has
+    labels = [QLabel('50°') for _ in range(13)]
+    for label in labels:
+        layout.addWidget(label)
+    top.setStyleSheet(default_styles)
+    top.show()
+    app.processEvents()
+
+    # a year of five minute refreshes would be ~100k, this is enough to see the difference
+    temps = [(i * 7) % 130 - 20 for i in range(500)]
+    lookups = [t / 10 for t in range(-500, 1200)] * 20
+
+    start = time.perf_counter()
+    for temp in lookups:
+        legacy_temperature_color(temp)
+    legacy_lookup = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    for temp in lookups:
+        get_temp_bucket(temp)
+    bucket_lookup = (time.perf_counter() - start) * 1000
+
+    stylesheet_ms = time_it(with_stylesheet, labels, temps)
+    for label in labels:
+        label.setStyleSheet('')
+    property_ms = time_it(with_property, labels, temps)
+
+    restyles = len(labels) * len(temps)
+    print(f'colour lookups ({len(lookups)}): if-chain {legacy_lookup:.1f}ms, bisect {bucket_lookup:.1f}ms')
+    print(f'restyling {restyles} labels: stylesheets {stylesheet_ms:.1f}ms '
+          f'({stylesheet_ms * 1000 / restyles:.1f}us each), temp-bucket {property_ms:.1f}ms '
+          f'({property_ms * 1000 / restyles:.1f}us each)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# a stand-in for overseer's light API, for trying the dashboard out without real lights
+#   python -m tools.fake_overseer [--port 8765] [--latency 0.2] [--lights 8] [--no-stream] [--no-bulk] [--toggle-state]
+# then set "overseer": "127.0.0.1:8765" in config.json. visiting /test/flip/<id> changes a light "elsewhere"
+import argparse
+import json
+import queue
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeOverseer:
+    def __init__(self, light_count=4, stream=True, toggle_state=False, latency=0.0, keep_alive=15, bulk=True):
+        self.lights = [{'id': str(i + 1), 'name': f'Light {i + 1}', 'on': i % 2 == 0} for i in range(light_count)]
+        self.stream = stream
+        self.bulk = bulk
+        # newer overseer versions answer toggles with the light's new state
+        self.toggle_state = toggle_state
+        self.latency = latency
+        self.keep_alive = keep_alive
+        self.subscribers = []
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def get_light(self, light_id):
+        return next((light for light in self.lights if light['id'] == light_id), None)
+
+    def set_on(self, light_id, on):
+        with self.lock:
+            light = self.get_light(light_id)
+            if light is None:
+                return None
+            light['on'] = on
+            update = dict(light)
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(update)
+        return update
+
+    def toggle(self, light_id):
+        light = self.get_light(light_id)
+        return self.set_on(light_id, not light['on']) if light is not None else None
+
+    def serve(self, port=8765):
+        server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(self))
+        server.daemon_threads = True
+        return server
+
+
+def make_handler(overseer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, data, status=200):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            with overseer.lock:
+                overseer.requests += 1
+            path = self.path.split('?')[0]
+
+            if path == '/lights/events':
+                return self.stream_events() if overseer.stream else self.send_json({'error': 'not found'}, 404)
+
+            time.sleep(overseer.latency)
+            if path == '/lights/info':
+                with overseer.lock:
+                    self.send_json(overseer.lights)
+            elif path.startswith('/lights/toggle/'):
+                update = overseer.toggle(path.rsplit('/', 1)[1])
+                if update is None:
+                    self.send_json({'error': 'no such light'})
+                else:
+                    self.send_json(update if overseer.toggle_state else {})
+            elif path.startswith('/test/flip/'):
+                self.send_json(overseer.toggle(path.rsplit('/', 1)[1]))
+            else:
+                self.send_json({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            with overseer.lock:
+                overseer.requests += 1
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(overseer.latency)
+
+            if self.path == '/lights/bulk' and overseer.bulk:
+                for change in json.loads(body.decode('utf-8')):
+                    overseer.set_on(change['id'], change['on'])
+                with overseer.lock:
+                    self.send_json(overseer.lights)
+            else:
+                self.send_json({'error': 'not found'}, 404)
+
+        def stream_events(self):
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+
+            events = queue.Queue()
+            with overseer.lock:
+                overseer.subscribers.append(events)
+                snapshot = json.dumps(overseer.lights)
+            try:
+                self.wfile.write(f'event: lights\ndata: {snapshot}\n\n'.encode('utf-8'))
+                self.wfile.flush()
+                while True:
+                    try:
+                        message = f'event: light\ndata: {json.dumps(events.get(timeout=overseer.keep_alive))}\n\n'
+                    except queue.Empty:
+                        message = ': keep-alive\n\n'
+                    self.wfile.write(message.encode('utf-8'))
+                    self.wfile.flush()
+            except OSError:
+                pass
+            finally:
+                with overseer.lock:
+                    overseer.subscribers.remove(events)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='stand-in overseer light API')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--lights', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before answering requests')
+    parser.add_argument('--no-stream', action='store_true', help='behave like an overseer without /lights/events')
+    parser.add_argument('--no-bulk', action='store_true', help='behave like an overseer without /lights/bulk')
+    parser.add_argument('--toggle-state', action='store_true', help='answer toggles with the new light state')
+    args = parser.parse_args()
+
+    overseer = FakeOverseer(args.lights, not args.no_stream, args.toggle_state, args.latency, bulk=not args.no_bulk)
+    print(f'fake overseer listening on 127.0.0.1:{args.port}')
+    overseer.serve(args.port).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# serves responses recorded with easy_requests.client.record() as a stand-in for openweather, weather.gov and
+# overseer, so the dashboard can be run and timed without any of them
+#   python -m tools.replay_server [--fixtures tools/fixtures] [--port 8770] [--latency 0.2]
+# every host is served from one port under /<host>/, it prints the "url-rewrites" for config.json that point the
+# dashboard at it
+import argparse
+import json
+import os
+import random
+import time
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+from easy_requests import recording_key, recording_response
+
+# openweather's timestamps that need to move along with the recordings, so old recordings still look like a forecast
+time_fields = ('dt', 'sunrise', 'sunset')
+
+
+def load_fixtures(directory):
+    fixtures = {}
+    for name in os.listdir(directory):
+        if name.endswith('.json') and name != 'config.json':
+            with open(os.path.join(directory, name)) as file:
+                recording = json.load(file)
+            fixtures[(recording['method'], recording['url'])] = recording
+    return fixtures
+
+
+def freshen(recording, now=None):
+    # moves every timestamp forward by however many whole days old the recording is, so weekdays and times of
+    # day stay the same but the forecast starts today
+    now = now or datetime.now()
+    recorded = datetime.fromtimestamp(recording['recorded-at'])
+    shift = (now.date() - recorded.date()).days * 24 * 60 * 60
+    if 'body' not in recording or shift == 0:
+        return recording
+
+    def move(value):
+        if isinstance(value, dict):
+            return {key: item + shift if key in time_fields and isinstance(item, int) else move(item)
+                    for key, item in value.items()}
+        elif isinstance(value, list):
+            return [move(item) for item in value]
+        return value
+
+    try:
+        body = json.dumps(move(json.loads(recording['body'])))
+    except ValueError:
+        return recording
+    return dict(recording, body=body, **{'recorded-at': recording['recorded-at'] + shift})
+
+
+def freshen_directory(directory, out_directory):
+    # a copy of some fixtures that can be replayed in process with easy_requests.client.replay()
+    os.makedirs(out_directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.json') and name != 'config.json':
+            with open(os.path.join(directory, name)) as file:
+                recording = freshen(json.load(file))
+            with open(os.path.join(out_directory, name), 'w') as file:
+                json.dump(recording, file)
+
+
+def rewrites(fixtures, base_url):
+    # url prefix -> where the replay server serves it, for easy_requests.client.rewrite()
+    hosts = sorted(set(recording['url'].split('/', 1)[0] for recording in fixtures.values()))
+    return [(f'{scheme}://{host}/', f'{base_url}/{host}/') for host in hosts for scheme in ('https', 'http')]
+
+
+class ReplayServer:
+    def __init__(self, fixtures, latency=0.0, jitter=0.0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self.misses = 0
+
+    def find(self, method, path):
+        # /<host>/<path>?<query> -> the recording for that url, the host just needs a scheme in front of it
+        return self.fixtures.get((method, recording_key(f'http:/{path}')))
+
+    def serve(self, port=8770):
+        server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(self))
+        server.daemon_threads = True
+        return server
+
+
+def make_handler(replay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately, which nagle would otherwise hold up waiting for an ack
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def answer(self, method):
+            replay.requests += 1
+            if self.headers.get('Content-Length'):
+                self.rfile.read(int(self.headers['Content-Length']))
+            time.sleep(max(0.0, replay.latency + random.uniform(-replay.jitter, replay.jitter)))
+
+            recording = replay.find(method, self.path)
+            if recording is None:
+                replay.misses += 1
+                body = json.dumps({'error': f'nothing recorded for {method} {urlsplit(self.path).path}'})
+                return self.send(404, [('Content-Type', 'application/json')], body.encode('utf-8'))
+
+            res = recording_response(self.path, freshen(recording))
+            etag = res.headers.get('ETag')
+            if etag and self.headers.get('If-None-Match') == etag:
+                return self.send(304, [('ETag', etag)], b'')
+            self.send(res.status, res.headers.items(), res.body)
+
+        def send(self, status, headers, body):
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.answer('GET')
+
+        def do_POST(self):
+            self.answer('POST')
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replays recorded API responses')
+    parser.add_argument('--fixtures', default='tools/fixtures')
+    parser.add_argument('--port', type=int, default=8770)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before answering requests')
+    parser.add_argument('--jitter', type=float, default=0.0, help='seconds the latency varies by either way')
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures)
+    print(f'replaying {len(fixtures)} responses on 127.0.0.1:{args.port}, point the dashboard at it with')
+    print(f'  "url-rewrites": {json.dumps(dict(rewrites(fixtures, f"http://127.0.0.1:{args.port}")), indent=4)}')
+    ReplayServer(fixtures, args.latency, args.jitter).serve(args.port).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
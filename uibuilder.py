@@ -1,50 +1,242 @@
+import hashlib
+import json
+import os
 import re
+from collections import OrderedDict
 
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QPixmap
-from PyQt5.QtWidgets import QHBoxLayout, QLabel, QGroupBox, QVBoxLayout, QPushButton, QScrollArea, QSizePolicy
+from PyQt5.QtWidgets import QHBoxLayout, QLabel, QGroupBox, QVBoxLayout, QPushButton, QScrollArea, QSizePolicy, \
+    QWidget
+
+from files import atomic_write
+from icons import icon_bundle, bundle_sizes, bundle_path
+import metrics
+
+
+indent_pattern = re.compile(r'\s*')
+ignored_line_pattern = re.compile(r'(\s*//)|(\s*$)')
+line_pattern = re.compile(r'(\w+)(?:#([\w\-]+)\b)?(?:\.([\w\-]*))?(?:\((.*)\))?(?: ([\w -]*))?')
+attr_separator_pattern = re.compile(r'\s*,\s*')
+layout_cache_dir = 'cache/layouts'
+# bump this whenever the layout tree format changes, so old compiled layouts are ignored
+layout_cache_version = 1
+# compiled layouts already loaded this run, by content hash
+compiled_layouts = {}
 
 
 def get_indent_level(line):
-    spaces = re.match(r'\s*', line)
-    if spaces:
-        return len(spaces[0]) / 4
-    return 0
+    return len(indent_pattern.match(line)[0]) / 4
 
 
 def parse_line(line):
-    def next_match(reg, text):
-        match = re.search(reg, text)
-        if match:
-            m = match.group(1)
-            return m, text[len(match.group(0)):]
-        return None, text
-
     indent = get_indent_level(line)
-    line = line.strip()
-    name, line = next_match(r'(\w+)', line)
-    id, line = next_match(r'#([\w\-_\d]+)\b', line)
-    class_name, line = next_match(r'\.([\w\-_\d]*)', line)
+    name, id, class_name, attr_match, text = line_pattern.match(line.strip()).groups()
 
     attrs = {}
-    attr_match, line = next_match(r'\((.*)\)', line)
     if attr_match:
-        for attr in re.split(r'\s*,\s*', attr_match):
+        for attr in attr_separator_pattern.split(attr_match):
             key, val = attr.split('=')
             attrs[key] = val
 
-    text, line = next_match(r' ([\w -]*)', line)
     return indent, name, id, class_name, attrs, text
 
 
+def parse_tree(raw):
+    # turns the layout text into a tree of [name, id, class, attrs, text, children] nodes in a single pass,
+    # each line's parent is whatever is left on the stack with a smaller indent
+    roots = []
+    stack = []  # (indent, children list) for each widget/layout the current line might be nested under
+    for line in raw.split('\n'):
+        if ignored_line_pattern.match(line):
+            continue
+
+        indent, name, id, class_name, attrs, text = parse_line(line)
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+
+        node = [name, id, class_name, attrs, text, []]
+        (stack[-1][1] if stack else roots).append(node)
+        stack.append((indent, node[5]))
+    return roots
+
+
+def compile_layout(raw):
+    # parsed layouts are kept on disk keyed by their contents, so unchanged layouts never need to be parsed again
+    key = hashlib.sha1(f'{layout_cache_version}\n{raw}'.encode('utf-8')).hexdigest()
+    if key in compiled_layouts:
+        return compiled_layouts[key]
+
+    cache_path = os.path.join(layout_cache_dir, f'{key}.json')
+    try:
+        with open(cache_path) as file:
+            tree = json.load(file)
+    except (OSError, ValueError):
+        tree = parse_tree(raw)
+        try:
+            os.makedirs(layout_cache_dir, exist_ok=True)
+            atomic_write(cache_path, json.dumps(tree, separators=(',', ':')))
+        except OSError as err:
+            print(f'[uibuilder] couldn\'t cache compiled layout: {err}')
+
+    compiled_layouts[key] = tree
+    return tree
+
+
+# decoded and scaled icons, shared by every UIBuilder so the same icon is only ever read from disk and
+# scaled once, least recently used pixmaps are dropped once the cache grows past max_bytes
+class PixmapCache:
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.pixmaps = OrderedDict()  # (icon name, size, device pixel ratio) -> QPixmap
+        self.strips = {}  # size -> the icon bundle's strip of every icon at that size
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, icon_name, size=None, dpr=1.0):
+        if not size:
+            # full size icons are shown as they are, the ratio doesn't matter
+            dpr = 1.0
+        key = (icon_name, size, dpr)
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            self.hits += 1
+            self.pixmaps.move_to_end(key)
+            return pixmap
+
+        self.misses += 1
+        if size in bundle_sizes and dpr == 1.0:
+            pixmap = self.from_bundle(icon_name, size)
+        else:
+            # no pre-scaled copy for this size, scale from the full size icon
+            pixmap = self.get(icon_name)
+            if not pixmap.isNull():
+                pixmap = pixmap.scaled(round(size * dpr), round(size * dpr), Qt.KeepAspectRatio,
+                                       Qt.FastTransformation)
+                pixmap.setDevicePixelRatio(dpr)
+
+        # a missing icon might just not be downloaded yet, don't remember that
+        if not pixmap.isNull():
+            self.add(key, pixmap)
+        return pixmap
+
+    def from_bundle(self, icon_name, size):
+        if not icon_bundle.has(icon_name):
+            return QPixmap()
+
+        strip = self.strips.get(size)
+        if strip is None:
+            strip = self.strips[size] = QPixmap(bundle_path(size))
+        cell = strip.height()
+        return strip.copy(icon_bundle.index(icon_name) * cell, 0, cell, cell)
+
+    def add(self, key, pixmap):
+        self.pixmaps[key] = pixmap
+        self.bytes += self.size_of(pixmap)
+        while self.bytes > self.max_bytes and len(self.pixmaps) > 1:
+            _, evicted = self.pixmaps.popitem(last=False)
+            self.bytes -= self.size_of(evicted)
+
+    def size_of(self, pixmap):
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    def clear(self):
+        self.pixmaps.clear()
+        self.strips.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.pixmaps),
+            'bytes': self.bytes
+        }
+
+
+pixmap_cache = PixmapCache()
+metrics.add_status('pixmaps', pixmap_cache.stats)
+
+
+# layout attributes that bind a widget to a key in the model given to UIBuilder.apply()
+binding_attrs = {
+    'bind': 'text',  # hidden while the value is None
+    'bind-icon': 'icon',  # sized with the 'icon-size' attribute
+    'bind-style': 'style'
+}
+# 'bind-prop-<name>' binds the dynamic property <name>, for styling with [<name>="value"] rules in styles.css.
+# much cheaper to change than a widget's own stylesheet, which has to be parsed again every time it's set
+property_binding_prefix = 'bind-prop-'
+# a value no model will ever have, so everything gets applied the first time
+unapplied = object()
+
+
 class UIBuilder:
     def __init__(self, widget, raw):
-        # ignore all comments and blank lines
-        self.raw = [line for line in raw.split('\n') if not re.match(r'(\s*//)|(\s*$)', line)]
         self.top = widget
         self.widgets_by_id = {}
         self.widgets_by_class = []
-        self.parse(self.top, 0, self.raw)
+        self.bindings = []  # [widget, kind, model key, icon size or property name, last applied value]
+        with metrics.timed('ui.parse'):
+            nodes = compile_layout(raw)
+        with metrics.timed('ui.build'):
+            self.build(self.top, nodes)
+
+    def apply(self, model):
+        # updates the widgets bound to keys in the model, but only ones whose value has changed since last time,
+        # all in one batch so there's only one relayout/repaint. returns the number of widgets touched
+        changed = [binding for binding in self.bindings
+                   if binding[2] in model and model[binding[2]] != binding[4]]
+        if not changed:
+            return 0
+
+        top = self.top if isinstance(self.top, QWidget) else self.top.parentWidget()
+        if top is not None:
+            top.setUpdatesEnabled(False)
+        try:
+            for binding in changed:
+                widget, kind, key, arg, _ = binding
+                value = binding[4] = model[key]
+                if kind == 'text':
+                    if value is None:
+                        widget.hide()
+                    else:
+                        self._set_widget_text(widget, value)
+                        widget.show()
+                elif kind == 'icon':
+                    widget.setPixmap(pixmap_cache.get(value, arg, widget.devicePixelRatioF()))
+                elif kind == 'style':
+                    widget.setStyleSheet(value)
+                    self._update_widget(widget)
+                elif kind == 'property':
+                    widget.setProperty(arg, value)
+                    self._update_widget(widget)
+        finally:
+            if top is not None:
+                top.setUpdatesEnabled(True)
+        return len(set(binding[0] for binding in changed))
+
+    def invalidate(self, kind=None):
+        # forget what was applied, so the next apply() updates everything (of one kind) again
+        for binding in self.bindings:
+            if kind is None or binding[1] == kind:
+                binding[4] = unapplied
+
+    def add(self, parent, raw):
+        # build more widgets into something that was already built
+        with metrics.timed('ui.parse'):
+            nodes = compile_layout(raw)
+        with metrics.timed('ui.build'):
+            self.build(parent, nodes)
+
+    def remove(self, id):
+        # takes a widget that was built back out, along with anything bound to it
+        widget = self.widgets_by_id.pop(id)
+        self.widgets_by_class = [w for w in self.widgets_by_class if w['widget'] is not widget]
+        self.bindings = [binding for binding in self.bindings if binding[0] is not widget]
+        widget.hide()
+        widget.deleteLater()
 
     def show(self, id):
         self.by_id(id).show()
@@ -59,8 +251,9 @@ class UIBuilder:
         return [w['widget'] for w in self.widgets_by_class if w['class'] == class_name]
 
     def set_text(self, id, text):
-        widget = self.by_id(id)
+        self._set_widget_text(self.by_id(id), text)
 
+    def _set_widget_text(self, widget, text):
         if hasattr(widget, 'setText'):
             widget.setText(text)
         else:
@@ -71,16 +264,19 @@ class UIBuilder:
         widget.setStyleSheet(ss)
         self._update_widget(widget)
 
+    def set_property(self, id, name, value):
+        widget = self.by_id(id)
+        if widget.property(name) != value:
+            widget.setProperty(name, value)
+            self._update_widget(widget)
+
     def set_icon(self, id, icon_name, size=None):
-        pixmap = QPixmap(f'cache/{icon_name}.png')
-        if size:
-            pixmap = pixmap.scaled(size, size, Qt.KeepAspectRatio, Qt.FastTransformation)
         widget = self.by_id(id)
-        widget.setPixmap(pixmap)
+        widget.setPixmap(pixmap_cache.get(icon_name, size, widget.devicePixelRatioF()))
 
     def _update_widget(self, widget):
-        self.top.style().unpolish(widget)
-        self.top.style().polish(widget)
+        widget.style().unpolish(widget)
+        widget.style().polish(widget)
 
     def on_click(self, id, func):
         widget = self.by_id(id)
@@ -106,72 +302,75 @@ class UIBuilder:
         else:
             raise ImportError(f'UIBuilder missing import for {widget_name}')
 
-    def parse(self, parent, level, lines):
-        last_line = None
-        skipping_children = False
-        for index, line in enumerate(lines):
-            indent, widget_name, id, class_name, attrs, text = parse_line(line)
-
-            if indent < level:  # done with this block
-                return
-            elif indent > level:  # need to add children to the previous created widget or layout
-                if not skipping_children:
-                    skipping_children = True
-                    self.parse(last_line, indent, lines[index:])
-                continue
-            elif skipping_children and level == indent:  # done skipping past children we've already parsed
-                skipping_children = False
-
+    def build(self, parent, nodes):
+        for widget_name, id, class_name, attrs, text, children in nodes:
             if widget_name == 'stretch':
                 parent.addStretch()
-            else:
-                w = self.create(widget_name)
-                last_line = w
-                if id:
-                    w.setObjectName(id)
-                    self.widgets_by_id[id] = w
-                if class_name:
-                    self.widgets_by_class.append({
-                        "widget": w,
-                        "class": class_name
-                    })
-                if attrs:
-                    def remove_attr(attr_name):
-                        del attrs[attr_name]
-
-                    if 'align' in attrs:
-                        alignments = {
-                            "left": Qt.AlignLeft,
-                            "right": Qt.AlignRight,
-                            "hcenter": Qt.AlignHCenter
-                        }
-                        w.setAlignment(alignments[attrs['align']])
-                        remove_attr('align')
-
-                    if 'expanding' in attrs and attrs['expanding'] == 'true':
-                        w.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
-                        remove_attr('expanding')
-
-                    if 'style' in attrs:
-                        w.setStyleSheet(attrs['style'])
-                        self._update_widget(w)
-                        remove_attr('style')
-
-                    if len(attrs) > 0:
-                        for key, val in attrs.items():
-                            w.setProperty(key, val)
-
-                if text:
-                    if hasattr(w, 'setText'):
-                        w.setText(text)
-                    else:
-                        w.setTitle(text)
+                continue
 
-                # add this widget to the parent
-                if 'layout' in widget_name.lower():
-                    if hasattr(parent, 'addLayout'):
-                        parent.addLayout(w)
-                    else:
-                        parent.setLayout(w)
+            w = self.create(widget_name)
+            if id:
+                w.setObjectName(id)
+                self.widgets_by_id[id] = w
+            if class_name:
+                self.widgets_by_class.append({
+                    "widget": w,
+                    "class": class_name
+                })
+            if attrs:
+                # the compiled tree is shared, don't modify its attrs
+                attrs = dict(attrs)
+
+                def remove_attr(attr_name):
+                    del attrs[attr_name]
+
+                if 'align' in attrs:
+                    alignments = {
+                        "left": Qt.AlignLeft,
+                        "right": Qt.AlignRight,
+                        "hcenter": Qt.AlignHCenter
+                    }
+                    w.setAlignment(alignments[attrs['align']])
+                    remove_attr('align')
+
+                if 'expanding' in attrs and attrs['expanding'] == 'true':
+                    w.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+                    remove_attr('expanding')
+
+                if 'style' in attrs:
+                    w.setStyleSheet(attrs['style'])
+                    self._update_widget(w)
+                    remove_attr('style')
+
+                for attr, kind in binding_attrs.items():
+                    if attr in attrs:
+                        size = int(attrs['icon-size']) if 'icon-size' in attrs else None
+                        self.bindings.append([w, kind, attrs[attr], size, unapplied])
+                        remove_attr(attr)
+                if 'icon-size' in attrs:
+                    remove_attr('icon-size')
+                for attr in [attr for attr in attrs if attr.startswith(property_binding_prefix)]:
+                    self.bindings.append([w, 'property', attrs[attr], attr[len(property_binding_prefix):], unapplied])
+                    remove_attr(attr)
+
+                if len(attrs) > 0:
+                    for key, val in attrs.items():
+                        w.setProperty(key, val)
+
+            if text:
+                if hasattr(w, 'setText'):
+                    w.setText(text)
                 else:
-                    parent.addWidget(w)
+                    w.setTitle(text)
+
+            # add this widget to the parent
+            if 'layout' in widget_name.lower():
+                if hasattr(parent, 'addLayout'):
+                    parent.addLayout(w)
+                else:
+                    parent.setLayout(w)
+            else:
+                parent.addWidget(w)
+
+            if children:
+                self.build(w, children)
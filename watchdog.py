@@ -0,0 +1,100 @@
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from PyQt5.QtCore import QObject, QTimer, Qt
+
+import metrics
+
+lag_seconds = metrics.Histogram('dashboard_event_loop_lag_seconds', 'How late the GUI thread\'s heartbeat timer fired')
+stall_seconds = metrics.Histogram('dashboard_gui_stall_seconds', 'How long the GUI thread was blocked, for stalls '
+                                                                 'longer than the watchdog threshold')
+# how stalls are grouped when they're summarised in the log, in ms
+stall_buckets = [250, 500, 1000, 2500, 5000, 10000]
+
+
+# watches for the GUI thread being blocked. a timer on the GUI thread beats every so often and measures how late it
+# fired, and a helper thread checks for beats that stop coming. while the GUI thread is stuck the helper logs where
+# its python stack is, which says what's doing the blocking
+class Watchdog(QObject):
+    def __init__(self, parent=None, interval=100, threshold=250, max_samples=5, history=200, report_interval=600):
+        super().__init__(parent)
+        self.interval = interval  # ms between heartbeats
+        self.threshold = threshold  # ms late before a beat counts as a stall
+        self.max_samples = max_samples  # stacks logged per stall, long stalls would flood the log otherwise
+        self.report_interval = report_interval  # seconds between summaries of recent stalls
+        self.stalls = deque(maxlen=history)  # (when, ms) of recent stalls
+        self.last_beat = time.monotonic()
+        self.last_report = time.monotonic()
+        self.main_thread_id = threading.main_thread().ident
+        self.stopped = None  # set to stop the helper thread, each start gets its own
+
+        # a precise timer, a coarse one is allowed to fire late on purpose which would look like lag
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.beat)
+
+    def log(self, msg):
+        print(f'[watchdog] {msg}')
+
+    def start(self):
+        if self.stopped is not None and not self.stopped.is_set():
+            return
+        self.last_beat = time.monotonic()
+        self.stopped = threading.Event()
+        self.timer.start(self.interval)
+        threading.Thread(target=self.watch, args=(self.stopped,), name='watchdog', daemon=True).start()
+
+    def stop(self):
+        self.timer.stop()
+        if self.stopped is not None:
+            self.stopped.set()
+
+    def beat(self):
+        now = time.monotonic()
+        late = max(0.0, now - self.last_beat - self.interval / 1000)
+        self.last_beat = now
+        lag_seconds.observe(late)
+
+        if late * 1000 >= self.threshold:
+            stall_seconds.observe(late)
+            self.stalls.append((time.time(), late * 1000))
+            self.log(f'GUI thread was blocked for {late * 1000:.0f}ms')
+
+        if self.stalls and now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.log(f'stalls in the last {len(self.stalls)}: {self.summary()}')
+
+    def summary(self):
+        counts = [0] * (len(stall_buckets) + 1)
+        for _, ms in self.stalls:
+            counts[next((i for i, bound in enumerate(stall_buckets) if ms < bound), len(stall_buckets))] += 1
+        labels = [f'<{bound}ms' for bound in stall_buckets] + [f'>={stall_buckets[-1]}ms']
+        return ', '.join(f'{label}: {count}' for label, count in zip(labels, counts) if count)
+
+    def watch(self, stopped):
+        # on the helper thread. only reads last_beat, which the GUI thread replaces in one assignment
+        sampled_beat = None
+        samples = 0
+        while not stopped.wait(self.threshold / 2000):
+            beat = self.last_beat
+            blocked_ms = (time.monotonic() - beat) * 1000 - self.interval
+            if blocked_ms < self.threshold:
+                continue
+
+            if beat != sampled_beat:
+                # a new stall
+                sampled_beat = beat
+                samples = 0
+            if samples < self.max_samples:
+                samples += 1
+                self.log_stack(blocked_ms)
+
+    def log_stack(self, blocked_ms):
+        frame = sys._current_frames().get(self.main_thread_id)
+        if frame is None:
+            return
+        stack = ''.join(traceback.format_stack(frame, limit=12)).rstrip()
+        self.log(f'GUI thread blocked for {blocked_ms:.0f}ms so far, in:\n{stack}')
@@ -1,144 +1,395 @@
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
-from os import path
 from urllib.error import HTTPError
 
-from config_reader import ConfigReader
+from config_reader import cfg
 from datetime import datetime
-from pretty import pretty_temp, pretty_weekday, pretty_date_str, pretty_length, pretty_relative_datetime, \
-    pretty_weekday
-import easy_requests
-
-cfg = ConfigReader()
-
-
-class Weather:
+from forecast import Period, Day, PrecipTimeline
+from pretty import pretty_relative_datetime, pretty_length_of_time
+from icons import icon_names
+import metrics
+from quota import quota
+from response_cache import ResponseCache
+
+# each part of the weather is fetched on its own schedule, since they change at very different rates
+sources = ('current', 'forecast', 'alerts')
+# openweather recalculates current conditions about every 10 minutes, and takes a little while to publish them
+current_update_interval = 60 * 10
+current_publish_delay = 60
+# anything that wasn't updated when it was expected to be, or couldn't be fetched, is checked again after this
+# long, doubling each time it happens again up to the longest
+retry_interval = 60
+retry_interval_max = 60 * 5
+# requests that don't depend on each other are run side by side on this
+fetch_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='weather-fetch')
+# openweather's free plan allows 60 calls a minute and 1,000,000 a month. weather.gov doesn't publish a limit,
+# but does turn away clients that call too often
+budget_defaults = {'openweather': (60, 1000000), 'weather-gov': (30, None)}
+
+
+def budget_limits(name):
+    per_minute, per_month = budget_defaults[name]
+    return cfg.get(f'{name}-per-minute', per_minute), cfg.get(f'{name}-per-month', per_month)
+
+
+openweather_budget = quota.budget('openweather', *budget_limits('openweather'))
+weather_gov_budget = quota.budget('weather-gov', *budget_limits('weather-gov'))
+refreshes_total = metrics.Counter('dashboard_weather_refreshes_total', 'Fetches of each part of the weather by '
+                                                                       'whether anything changed', ['source', 'result'])
+# settings that mean everything fetched so far is for the wrong place, they're read again for every fetch
+location_settings = {'zip-code', 'weather-api-key'}
+# settings configure_schedule() reads
+schedule_settings = {'forecast-interval', 'alerts-interval', 'openweather-per-minute', 'openweather-per-month',
+                     'weather-gov-per-minute', 'weather-gov-per-month'}
+
+
+def configure_schedule():
+    # run again whenever config.json changes. the new intervals take effect from each source's next fetch
+    global forecast_interval, alerts_interval
+    # the forecast is in 3 hour steps and its model is rerun a few times a day, there's no point checking it often
+    forecast_interval = cfg.get('forecast-interval', 60 * 30)
+    alerts_interval = cfg.get('alerts-interval', 60 * 5)
+    for budget in [openweather_budget, weather_gov_budget]:
+        budget.set_limits(*budget_limits(budget.name))
+
+
+configure_schedule()
+
+
+class WeatherState:
+    # everything derived from one refresh, built off the GUI thread and swapped in all at once. a refresh of one
+    # source shares everything it didn't change with the state before it
     def __init__(self):
-        # get a url to get the forecast based on the coordinates
-        self.updated = ''
         self.location_name = ''
-        self.forecast_today = {}
+        self.fetch_ms = None  # how long the refresh that built this took end to end
+        self.current = None  # a Period, current conditions just as openweather reported them
+        self.forecast_today = None  # current conditions with the rest of today's low and high folded in
         self.coords = {}  # lon and lat, from openweather for checking weather.gov weather alerts
         self.active_alerts = []
         self.periods = []
-        self.days = []
-        self.refresh()
+        self.days = []  # by how many days from now they are
+        self.organized_on = None  # the date days was worked out on, it's out of date after midnight
+        self.precip = {}  # 'rain'/'snow' -> PrecipTimeline
+        self.stale = False  # restored from the startup snapshot and not refreshed yet
+        self.refreshed = set()  # the sources fetched since it was restored, it's caught up once that's all of them
+        self.changed = set()  # the sources that changed in the refresh that built this
+        self.next_fetch = {}  # source -> when it's next due to be fetched, as a timestamp
+        self.retries = {}  # source -> how many times in a row it's been late or failed
 
-    def make_api_call(self, api):
+
+class Weather:
+    def __init__(self):
+        self.state = WeatherState()
+        self.responses = ResponseCache()
+
+    def log(self, msg):
+        print(f'[weather] {msg}')
+
+    def api_url(self, api):
+        return f'https://api.openweathermap.org/data/2.5/{api}&units=imperial&APPID={cfg.get("weather-api-key")}'
+
+    def make_api_call(self, api, ttl):
+        # returns the response and whether it changed since the last time it was fetched
         try:
-            return easy_requests.get(
-                f'https://api.openweathermap.org/data/2.5/{api}&units=imperial&APPID={cfg.get("weather-api-key")}')
+            with metrics.timed(f'openweather.{api.split("?")[0]}'):
+                return self.responses.get(self.api_url(api), ttl, openweather_budget)
         except HTTPError as err:
             if err.getcode() == 401:
                 print('Weather API key was rejected. It\'s either invalid or it hasn\'t been activated yet. Verify it '
                       'is correct or try again later.')
                 sys.exit(-1)
+            raise
 
-    def make_alerts_call(self, dt):
-        lat = self.coords['lat']
-        lon = self.coords['lon']
-        alerts = easy_requests.get(f'https://api.weather.gov/alerts/active?point={lat}%2C{lon}')
+    def make_alerts_call(self, coords):
+        lat = coords['lat']
+        lon = coords['lon']
+        with metrics.timed('weather-gov.alerts'):
+            alerts, changed = self.responses.get(f'https://api.weather.gov/alerts/active?point={lat}%2C{lon}',
+                                                 budget=weather_gov_budget)
 
-        self.active_alerts = []
+        active_alerts = []
         for alert in list(alert['properties'] for alert in alerts['features']):
-            self.active_alerts.append({
+            active_alerts.append({
                 'headline': alert['headline'],
                 'description': alert['description']
             })
+        return active_alerts, changed
+
+    def refresh(self, sources=None):
+        self.apply(self.fetch(sources))
+
+    def apply(self, state):
+        # a single assignment, so readers only ever see a complete refresh
+        if state is not None:
+            self.state = state
+
+    def due_sources(self, now):
+        # everything that's never been fetched is due right away
+        return [source for source in sources if self.state.next_fetch.get(source, 0) <= now + 1]
+
+    def next_fetch_in(self):
+        # seconds until the next source is due
+        if not self.state.next_fetch:
+            return 0
+        return max(0, min(self.state.next_fetch.get(source, 0) for source in sources) - time.time())
+
+    def fetch(self, sources=None):
+        # fetches whichever sources are due (or the ones asked for) and builds a new state from them, sharing
+        # whatever didn't change with the current one. nothing on self is touched so this is safe to run off
+        # the GUI thread. returns None if nothing was due
+        now = time.time()
+        old = self.state
+        sources = self.due_sources(now) if sources is None else sources
+        if not sources:
+            return None
+
+        start = time.perf_counter()
+        zip_code = cfg.get("zip-code")
+        futures = {}
+        if 'current' in sources:
+            futures['current'] = fetch_pool.submit(self.make_api_call, f'weather?zip={zip_code}',
+                                                   current_update_interval)
+        if 'forecast' in sources:
+            futures['forecast'] = fetch_pool.submit(self.make_api_call, f'forecast?zip={zip_code}', forecast_interval)
+        # alerts need coordinates, which come from the current weather. the location rarely changes so use
+        # the last known coordinates to start right away, and only fetch again if they turn out to be different
+        if 'alerts' in sources and old.coords:
+            futures['alerts'] = fetch_pool.submit(self.make_alerts_call, old.coords)
+
+        state = copy(old)
+        state.changed = set()
+        state.next_fetch = dict(old.next_fetch)
+        state.retries = dict(old.retries)
+        fetched = set()
+
+        def result(source):
+            try:
+                res = futures[source].result()
+                fetched.add(source)
+                return res
+            except Exception as err:
+                self.log(f'error fetching {source}: {err}')
+                refreshes_total.inc(source=source, result='failed')
+                self.retry_later(state, source, now)
+                return None
 
-    def refresh(self):
-        today_forecast = self.make_api_call(f'weather?zip={cfg.get("zip-code")}')
-        self.coords = today_forecast['coord']
-        self.make_alerts_call(datetime.now())
-        self.forecast_today = self.collect_weather_information(today_forecast)
-        for temp_type in ['temp', 'low', 'high']:
-            self.forecast_today[temp_type + '-pretty'] = pretty_temp(self.forecast_today[temp_type])
-        self.location_name = today_forecast['name']
-
-        # get forecast for the next few days
-        forecast5 = self.make_api_call(f'forecast?zip={cfg.get("zip-code")}')
-        self.periods = []
-        for period in forecast5['list']:
-            self.periods.append(self.collect_weather_information(period))
-
-        def make_pretty(data):
-            data['rain'] = f"{pretty_length(data['rain'])} rain" if data['rain'] else None
-            data['snow'] = f"{pretty_length(data['snow'])} snow" if data['snow'] else None
-
-            for temp_type in ['temp', 'low', 'high']:
-                if temp_type in data:
-                    data[temp_type + '-pretty'] = pretty_temp(data[temp_type])
-            return data
-
-        # figure out day totals
-        self.days = [None] * (1 + max(x['days-from-now'] for x in self.periods))
-        self.periods_by_day = copy(self.days)
-        for period in self.periods:
-            delta = period['days-from-now']
-            if not self.days[delta]:
-                dt = period['dt'].date()
-                self.days[delta] = {
-                    "dt": dt,
-                    "dt-pretty": pretty_weekday(dt),
-                    "rain": 0,
-                    "snow": 0,
-                    "low": period['low'],
-                    "high": period['high'],
-                    "weather-mains": []
-                }
-                self.periods_by_day[delta] = []
-            this_day = self.days[delta]
-            this_day['low'] = min(this_day['low'], period['low'])
-            this_day['high'] = max(this_day['high'], period['high'])
-            this_day['rain'] += period['rain']
-            this_day['snow'] += period['snow']
-            this_day['weather-mains'].append(period['weather-main'])
-            self.periods_by_day[delta].append(make_pretty(copy(period)))
-
-        # make everything look pretty, now that we've organized all the data
-        for day in self.days:
-            if day is not None:
-                day = make_pretty(day)
-                # get the weather type that's happening the most
-                mains = day['weather-mains']
-                most_frequent_weather = max(set(mains), key=mains.count)
-                day['weather'] = most_frequent_weather
-                # pick an icon based on the most main one, eventually this can be more detailed with
-                # better daily summaries
-                day['weather-icon'] = {
-                    'Rain': '10d',
-                    'Snow': '13d',
-                    'Drizzle': '09d',
-                    'Thunderstorm': '11d',
-                    'Clear': '01d',
-                    'Clouds': '03d'
-                }[most_frequent_weather]
-                self.cache_icon(day['weather-icon'])
-
+        def record(source, changed):
+            refreshes_total.inc(source=source, result='changed' if changed else 'unchanged')
+            if changed:
+                state.changed.add(source)
+
+        if 'current' in futures:
+            res = result('current')
+            if res is not None:
+                today_forecast, changed = res
+                changed = changed or old.current is None
+                if changed:
+                    self.set_current(state, today_forecast)
+                # openweather publishes new conditions a while after the last ones, if they're late check back soon
+                due = today_forecast['dt'] + current_update_interval + current_publish_delay
+                if due > now:
+                    state.retries['current'] = 0
+                    self.schedule(state, 'current', self.stretch(due, now), f'weather?zip={zip_code}')
+                else:
+                    self.retry_later(state, 'current', now, f'weather?zip={zip_code}')
+                record('current', changed)
+
+        if 'alerts' in sources:
+            if state.coords and ('alerts' not in futures or state.coords != old.coords):
+                futures['alerts'] = fetch_pool.submit(self.make_alerts_call, state.coords)
+            if 'alerts' in futures:
+                res = result('alerts')
+                if res is not None:
+                    state.active_alerts, changed = res
+                    state.retries['alerts'] = 0
+                    state.next_fetch['alerts'] = now + alerts_interval
+                    record('alerts', changed)
+            else:
+                # no coordinates yet, they'll be here once current conditions have been fetched
+                state.next_fetch['alerts'] = now + retry_interval
+        elif state.coords != old.coords and old.coords:
+            # the alerts we have are for somewhere else
+            state.next_fetch['alerts'] = now
+
+        if 'forecast' in futures:
+            res = result('forecast')
+            if res is not None:
+                forecast5, changed = res
+                changed = changed or not old.periods
+                if changed:
+                    with metrics.timed('weather.parse'):
+                        state.periods = [self.collect_weather_information(period) for period in forecast5['list']]
+                    with metrics.timed('weather.days'):
+                        self.organize(state)
+                state.retries['forecast'] = 0
+                self.schedule(state, 'forecast', self.stretch(now + forecast_interval, now), f'forecast?zip={zip_code}')
+                record('forecast', changed)
+
+        if state.periods and state.organized_on != datetime.now().date():
+            # it's a new day, so the forecast is split up into days again even though openweather hasn't changed it
+            with metrics.timed('weather.days'):
+                self.organize(state)
+            state.changed.add('forecast')
+
+        # only the parts of the day data that depend on what changed are worked out again
+        if state.changed & {'current', 'forecast'}:
+            self.combine_today(state)
+            with metrics.timed('weather.icons'):
+                self.cache_icons(([state.current.weather_icon] if state.current else []) +
+                                 [period.weather_icon for period in state.periods] +
+                                 [day.weather_icon for day in state.days if day is not None])
+
+        if old.stale:
+            # current conditions and the forecast are usually fetched separately, so the snapshot is caught up on
+            # once both have been, even if none of it changed
+            state.refreshed = old.refreshed | fetched
+            if {'current', 'forecast'} <= state.refreshed:
+                state.stale = False
+                state.changed |= fetched
+
+        state.fetch_ms = (time.perf_counter() - start) * 1000
+        metrics.phase_seconds.observe(state.fetch_ms / 1000, phase='weather.fetch')
+        changes = ', '.join(sorted(state.changed)) or 'nothing'
+        self.log(f'fetched {", ".join(sorted(fetched)) or "nothing"} in {state.fetch_ms:.0f}ms, {changes} changed. '
+                 f'next {self.describe_schedule(state)}')
+        return state
+
+    def schedule(self, state, source, due, api):
+        state.next_fetch[source] = due
+        # the cached response is good until then, so restarting in the meantime doesn't spend a call on it
+        self.responses.expire(self.api_url(api), due)
+
+    def retry_later(self, state, source, now, api=None):
+        retries = state.retries.get(source, 0)
+        state.retries[source] = retries + 1
+        due = now + min(retry_interval * 2 ** retries, retry_interval_max)
+        if api is not None:
+            self.schedule(state, source, due, api)
+        else:
+            state.next_fetch[source] = due
+
+    def stretch(self, due, now):
+        # later than planned if keeping to the schedule would use up the month's openweather budget early, and
+        # never before openweather said it's ok to call again
+        factor = openweather_budget.stretch(1 / current_update_interval + 1 / forecast_interval)
+        return max(now + (due - now) * factor, now + openweather_budget.wait_time(now))
+
+    def describe_schedule(self, state=None):
+        state = state or self.state
+        now = time.time()
+        return ', '.join(f'{source} in {pretty_length_of_time(max(0, state.next_fetch[source] - now))}'
+                         for source in sources if source in state.next_fetch)
+
+    def status(self):
+        # for the /status page
+        now = time.time()
+        return {source: {'next-fetch-in': round(max(0, self.state.next_fetch[source] - now)),
+                         'retries': self.state.retries.get(source, 0)}
+                for source in sources if source in self.state.next_fetch}
+
+    def build_state(self, today_forecast, forecast5, active_alerts):
+        # everything at once, without the network
+        state = WeatherState()
+        state.active_alerts = active_alerts
+        with metrics.timed('weather.parse'):
+            state.periods = [self.collect_weather_information(period) for period in forecast5['list']]
+            self.set_current(state, today_forecast)
+        with metrics.timed('weather.days'):
+            self.organize(state)
+            return self.combine_today(state)
+
+    def set_current(self, state, today_forecast):
+        state.coords = today_forecast['coord']
+        state.location_name = today_forecast['name']
+        state.current = self.collect_weather_information(today_forecast)
+
+    def organize(self, state):
+        # figure out day totals, periods are shared with their day rather than copied. periods from before today
+        # are left out of the days, but kept for the precipitation timelines
+        now = datetime.now()
+        today = datetime(now.year, now.month, now.day)
+        state.periods = [period.counted_from(today) for period in state.periods]
+        state.organized_on = today.date()
+        upcoming = [period for period in state.periods if period.days_from_now >= 0]
+        periods_by_day = [None] * (1 + max((period.days_from_now for period in upcoming), default=-1))
+        for period in upcoming:
+            delta = period.days_from_now
+            if periods_by_day[delta] is None:
+                periods_by_day[delta] = []
+            periods_by_day[delta].append(period)
+        state.days = [Day(periods) if periods else None for periods in periods_by_day]
+        state.precip = {precip_type: PrecipTimeline(state.periods, precip_type) for precip_type in ['rain', 'snow']}
+        return state
+
+    def combine_today(self, state):
         # see if there are any more extreme low/highs in periods for today
-        if self.days[0] is not None:
-            fc = self.forecast_today
-            today = self.days[0]
-            fc['low'] = min(fc['low'], today['low'])
-            fc['high'] = max(fc['high'], today['high'])
-            self.forecast_today = make_pretty(fc)
+        fc = state.current
+        if fc is not None and state.days and state.days[0] is not None:
+            today = state.days[0]
+            fc = fc.with_range(min(fc.low, today.low), max(fc.high, today.high))
+        state.forecast_today = fc
+        return state
+
+    def dump(self):
+        # a compact copy of the current weather for the startup snapshot
+        state = self.state
+        if state.current is None:
+            return None
+        return {
+            'location': state.location_name,
+            'coords': state.coords,
+            'alerts': state.active_alerts,
+            'today': state.current.dump(),
+            'periods': [period.dump() for period in state.periods]
+        }
+
+    def restore(self, data, stale=True):
+        # builds a state from a snapshot, or from the daemon (which is current, so isn't stale). returns None if
+        # it's too old to have anything left to show
+        now = datetime.now()
+        today = datetime(now.year, now.month, now.day)
+        periods = [Period.load(values, today) for values in data['periods']]
+        periods = [period for period in periods if period.days_from_now >= 0]
+        if not periods:
+            return None
+
+        state = WeatherState()
+        state.location_name = data['location']
+        state.coords = data['coords']
+        state.active_alerts = data['alerts']
+        state.current = Period.load(data['today'], today)
+        state.periods = periods
+        state.stale = stale
+        return self.combine_today(self.organize(state))
+
+    def is_stale(self):
+        return self.state.stale
+
+    def has_weather(self):
+        # current conditions and a forecast, either can be missing if it couldn't be fetched on a first start
+        return self.state.forecast_today is not None and bool(self.state.days)
 
     def get_upcoming_precip_message(self):
         now = self.get_todays_forecast()
 
         def get_precip_message(precip_type, is_currently_precipitating):
-            next_precip_dt = next((period['dt'] for period in self.periods if period[precip_type] != 0), None)
-            next_clear_dt = next((period['dt'] for period in self.periods if period[precip_type] == 0), None)
+            timeline = self.state.precip[precip_type]
+            next_precip_dt = timeline.next_start(now.dt)
+            next_clear_dt = timeline.next_stop(now.dt)
 
             if is_currently_precipitating:
+                if next_clear_dt is None:
+                    return f'The {precip_type} isn\'t expected to let up for the rest of the forecast.'
                 return f'The {precip_type} should let up {pretty_relative_datetime(next_clear_dt)}.'
             elif next_precip_dt:
                 return f'It will {precip_type} {pretty_relative_datetime(next_precip_dt)}.'
             else:
                 return None
 
-        return (get_precip_message('rain', now['weather-id'] < 600),
-                get_precip_message('snow', 600 <= now['weather-id'] < 700))
+        return (get_precip_message('rain', now.weather_id < 600),
+                get_precip_message('snow', 600 <= now.weather_id < 700))
 
     def collect_weather_information(self, forecast):
         temps = forecast['main']
@@ -162,52 +413,46 @@ class Weather:
         def mm_to_inch(mm):
             return 0.0393701 * mm
 
-        self.cache_icon(weather['icon'])
-
-        return {
-            "dt": dt,
-            "days-from-now": (dt - today).days,
-            "dt-pretty": pretty_date_str(dt),
-            "temp": temps['temp'],
+        return Period(
+            dt=dt,
+            days_from_now=(dt - today).days,
+            temp=temps['temp'],
             # temp_min and temp_max aren't min and max in this time period, it's min and max in the region
-            "low": temps['temp'],
-            "high": temps['temp'],
-            "weather": weather["description"],
-            "weather-main": weather["main"],
-            "weather-id": weather["id"],
-            "weather-icon": weather["icon"],
+            low=temps['temp'],
+            high=temps['temp'],
+            weather=weather["description"],
+            weather_main=weather["main"],
+            weather_id=weather["id"],
+            weather_icon=weather["icon"],
             # regardless of imperial setting, we get mm as units
-            "rain": mm_to_inch(get_precip_amount('rain')),
-            "snow": mm_to_inch(get_precip_amount('snow'))
-        }
+            rain=mm_to_inch(get_precip_amount('rain')),
+            snow=mm_to_inch(get_precip_amount('snow'))
+        )
 
     def get_updated_time(self):
-        return self.forecast_today['dt-pretty']
+        return self.state.forecast_today.dt_pretty
 
     def get_todays_forecast(self):
-        forecast = copy(self.forecast_today)
-        if len(self.active_alerts) > 0:
-            forecast['alerts'] = copy(self.active_alerts)
+        # periods can't be changed, so they're handed out as they are instead of copied
+        return self.state.forecast_today
 
-        return forecast
+    def get_alerts(self):
+        return self.state.active_alerts
 
     def get_days(self):
-        return self.days
+        return self.state.days
 
     def get_periods_by_day(self, day=None):
         if not day:
-           return self.periods_by_day[0]
-
-        for day_, periods in zip(self.days, self.periods_by_day):
-            if day_ == day:
-                return periods
+            day = self.state.days[0]
+        return day.periods if day else ()
 
     def get_location_name(self):
-        return self.location_name
-
-    def cache_icon(self, icon_name):
-        icon_path = f'cache/{icon_name}.png'
-        if not path.exists(icon_path):
-            image_data = easy_requests.get(f'http://openweathermap.org/img/wn/{icon_name}@2x.png', 'image/png')
-            with open(icon_path, 'wb') as file:
-                file.write(image_data)
+        return self.state.location_name
+
+    def cache_icons(self, names):
+        # every icon is downloaded ahead of time by the icon bundle, so all that's left is making sure
+        # openweather hasn't started using one we don't know about
+        unknown = set(icon_name for icon_name in names if icon_name not in icon_names)
+        if unknown:
+            self.log(f'no bundled icon for {", ".join(sorted(unknown))}')